@@ -1,58 +1,50 @@
-   
+
 # Import all required packages
-import pandas as pd
-import numpy as np
-import multiprocessing as mp
-import csv
 import sys
-import os
-
-# read in the dataframe
-#df = pd.read_csv('chr1_A_matrix.csv', index_col=0)
-
-outprefix = sys.argv[1]
-data = sys.argv[2]
-num_partitions = int(sys.argv[3])
-num_processors = int(sys.argv[4])
-df = pd.read_csv(data, index_col=0)
-
-# Generate all unique combinations of columns and store as a list in pair
-pair = [[i, j] for i in range(len(df.columns)-1) for j in range(i+1, len(df.columns))]
-    
-# Split the list subarrays
-pair_split = np.array_split(pair, num_partitions)
-    
-# Define the function that compares elements of the two columns and calculates percentage difference in the columns
-# Fix the dataframe argument to take in the df of interest and let combination remain a variable to iterate over
-def Perc_diff(combn, df = df):
-    pair = df.iloc[:, combn]
-    pairNoNA = pair.dropna()
-    TotalSites = pairNoNA.shape[0]
-    DiffSites = np.sum(pairNoNA[pairNoNA.columns[0]] != pairNoNA[pairNoNA.columns[1]])
-    PercDiff = round((DiffSites * 100)/ TotalSites, 2)
-    # Generate a list as output
-    result = [pair.columns[0], pair.columns[1], TotalSites, DiffSites, PercDiff]
-    
-    return result
-
-
-def SNP_parallel(x):
-    #Using multiprocessing for parallel computation, instantiate pool and assign the total number of cores available using mp.cpu_count()
-    pool = mp.Pool(num_processors)
-    # Apply the funtion over one subarray of pair_split at a time usine pool.map as follows
-    results = pool.map(Perc_diff, [combn for combn in pair_split[x]])
-    # Do not forget to close the pool
-    pool.close()
-    
-    return results
-   
-x = int(sys.argv[5])
-print("x is ", x)
-results = SNP_parallel(x)
-# Convert the results list into a dataframe
-Results = pd.DataFrame(results, columns = ['Sample1', 'Sample2', 'Total_sites', 'Diff_Sites', 'Percent_Diff'])
-
-# Save the results dataframe as a csv file
-Results.to_csv(outprefix+'/'+outprefix+'_%s.csv' %x, index=False)
-print(Results.head())
 
+from hpc4ag.snp import (read_genotypes, choose_tile_size, upper_triangle_tiles,
+                        assign_tiles, compare_tiles, pairs_to_frame, pairs_to_array, save_pairs)
+from hpc4ag.slurm import write_json
+
+# Define the function that compares every pair of columns in the tiles assigned to partition x.
+# The upper triangle of the sample-by-sample matrix is split into square tiles that are balanced
+# across partitions, and each tile is counted as one batched operation instead of pair by pair.
+# The pool workers attach to a single shared copy of the genotypes and only receive tile coordinates.
+def SNP_parallel(genotypes, x, num_partitions, num_processors):
+    n_samples = len(genotypes['samples'])
+    tile_size = choose_tile_size(n_samples, num_partitions * num_processors)
+    tiles = assign_tiles(upper_triangle_tiles(n_samples, tile_size), num_partitions)[x]
+    return compare_tiles(genotypes, tiles, num_processors=num_processors)
+
+# Everything below only runs in the main process, so spawned pool workers do not re-read the data
+if __name__ == '__main__':
+    # read in the dataframe
+    #df = pd.read_csv('chr1_A_matrix.csv', index_col=0)
+    # or a packed genotype directory written once with hpc4ag.snp.convert_genotypes
+
+    outprefix = sys.argv[1]
+    data = sys.argv[2]
+    num_partitions = int(sys.argv[3])
+    num_processors = int(sys.argv[4])
+
+    # Read the genotypes as a compact integer array (or packed 2-bit words) with missing calls marked
+    genotypes = read_genotypes(data)
+
+    x = int(sys.argv[5])
+    # Optional output format: csv (default) or npy for typed binary columns
+    out_format = sys.argv[6] if len(sys.argv) > 6 else 'csv'
+    print("x is ", x)
+    results = SNP_parallel(genotypes, x, num_partitions, num_processors)
+
+    if out_format == 'npy':
+        # Save int32 sample indices and counts and float32 percentages, plus the sample names once.
+        # hpc4ag.snp.merge_pairs assembles the parts into a condensed distance matrix.
+        save_pairs(outprefix+'/'+outprefix+'_%s.npy' %x, pairs_to_array(*results))
+        write_json(genotypes['samples'], outprefix+'/'+outprefix+'_samples.json')
+        sys.exit(0)
+    # Convert the results into a dataframe
+    Results = pairs_to_frame(genotypes['samples'], *results)
+
+    # Save the results dataframe as a csv file
+    Results.to_csv(outprefix+'/'+outprefix+'_%s.csv' %x, index=False)
+    print(Results.head())
@@ -0,0 +1,113 @@
+# Compares hpc4ag.kmers.frequent_words with the FrequentWords and BetterFrequentWords
+# functions of the Profile-kmers notebook on a random DNA sequence, checking that all
+# three return the same k-mers.
+#
+#   python benchmarks/kmers.py [length] [k]
+#
+# FrequentWords is quadratic in the length and is only timed up to 20000 bases.
+import sys
+import timeit
+import numpy as np
+
+from hpc4ag.kmers import frequent_words
+
+def FrequentWords(Text, k):
+    '''
+    This function takes a string Text and a number k as input to find the 
+    most frequently occuring substring of length k within Text.
+    It uses a sliding window approach to scan the Text and note each pattern of length k 
+    and keeps count of every time the pattern is found subsequently in the string.
+    It returns the most frequently occuring k-mer string as output.
+    '''
+    FrequentPatterns = []
+    n = len(Text)
+    Count = [0] * (n-k+1)
+    
+    for i in range(n-k+1):
+        Pattern = Text[i: i+k]
+        Count[i] = PatternCount(Text, Pattern)
+    m = max(Count)
+    
+    for i in range(n-k+1):
+        if Count[i] == m:
+            FrequentPatterns.append(Text[i:i+k])
+    
+    #remove duplicates from FrequentPatterns
+    FrequentPatterns = list(set(FrequentPatterns))
+        
+    return FrequentPatterns
+
+
+def PatternCount(Text, Pattern):
+    '''
+    This function counts how many times the smaller substring Pattern occurs in the longer string Text 
+    and returns the number count.
+    '''
+    count = 0
+    for i in range(len(Text)-len(Pattern)+1):
+        if Text[i:i+len(Pattern)] == Pattern:
+            count += 1
+            
+    return count
+def BetterFrequentWords(Text, k):
+    '''
+    This function takes a string Text and an integer k as input 
+    and returns the most frequently occuring substring k.
+    It uses the FrequencyTable and MaxMap subroutines to generate 
+    a dictionary of k-mers and their count, and to find the maximum value.
+    It returns a list of k-mers corresponding to the maximum value.
+    '''
+    FrequentPatterns = []
+    freqMap = FrequencyTable(Text, k)
+    maxval = MaxMap(freqMap)
+    for k,v in freqMap.items():
+        if v == maxval:
+            FrequentPatterns.append(k)
+            
+    return FrequentPatterns
+		
+def MaxMap(freqmap):
+    '''
+    Takes a dictionary freqmap as input and returns 
+    the maximum value in the dictionary.
+    '''
+    maxvalue = max(freqmap.values())
+    return maxvalue
+	
+
+def FrequencyTable(Text, k):
+    '''
+    It takes a string Text and an integer k as input.
+    Generates a dictionary using k-mers as keys and 
+    increments the value every time the k-mer is present in the string Text.
+    Returns this dictionary.
+    '''
+    freqMap = {}
+    n = len(Text)
+    for i in range(n-k+1):
+        pattern = Text[i:i+k]
+        if pattern in freqMap.keys():
+            freqMap[pattern] += 1
+        else:
+            freqMap[pattern] = 1
+    return freqMap
+
+def random_sequence(length, seed=42):
+    rng = np.random.default_rng(seed)
+    return ''.join(rng.choice(list('ACGT'), size=length))
+
+if __name__ == '__main__':
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 9
+    text = random_sequence(length)
+    expected = sorted(BetterFrequentWords(text, k))
+    functions = [('BetterFrequentWords', BetterFrequentWords), ('frequent_words', frequent_words)]
+    if length <= 20000:
+        functions.insert(0, ('FrequentWords', FrequentWords))
+    timings = {}
+    for name, function in functions:
+        assert sorted(function(text, k)) == expected, "{} differs".format(name)
+        timings[name] = min(timeit.repeat(lambda: function(text, k), number=1, repeat=3))
+    reference = functions[0][0]
+    for name, seconds in timings.items():
+        print("{}: {:.4f} s, speedup over {} {:.1f}x".format(name, seconds, reference, timings[reference] / seconds))
@@ -0,0 +1,312 @@
+# Benchmarks the hpc4ag hot paths on synthetic data and writes the wall time, peak RSS and
+# throughput of each to JSON, so that runs can be compared across commits and core counts.
+# Every benchmark runs in a fresh process, so its peak RSS is not inflated by the others.
+#
+#   python benchmarks/run.py [--scale 1] [--repeat 3] [--processors 1] [--only NAME ...]
+#                            [--profile cprofile|line] [--workdir DIR] [--output FILE]
+#   python benchmarks/run.py --list
+#   python benchmarks/run.py --compare OLD.json NEW.json
+#
+# --scale multiplies the size of every synthetic input. --profile cprofile writes one .prof file
+# per benchmark (open with python -m pstats or snakeviz); --profile line writes line-by-line
+# timings of the benchmarked hpc4ag functions and needs the line_profiler package.
+import os
+import sys
+import time
+import json
+import math
+import socket
+import cProfile
+import datetime
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from hpc4ag.slurm import write_json
+from divide_image import synthetic_field
+
+Bands = ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B11', 'B12']
+
+def synthetic_sample(height, width, num_dates=31, seed=42):
+    # Field sample laid out like the Sentinel-2 pickles of the crop type notebooks
+    rng = np.random.default_rng(seed)
+    stack = rng.uniform(0, 0.6, size=(num_dates, len(Bands), height, width)).astype(np.float32)
+    rows, cols = np.ogrid[:height, :width]
+    mask = ((rows - height / 2) ** 2 / (height / 2) ** 2 + (cols - width / 2) ** 2 / (width / 2) ** 2 <= 1).astype(np.uint8)
+    dates = [str(np.datetime64('2022-04-01') + 5 * d) for d in range(num_dates)]
+    return {'grid_info': [{'bands': Bands}],
+            'samples': [{'grids': [{'stack': stack, 'mask': mask, 'dates': dates}]}]}
+
+def synthetic_patches(n_fields, patches_per_field, num_dates=31, n_classes=4, seed=42):
+    # Dictionary of field IDs and patches plus one hot encoded labels, as written by create_patches
+    rng = np.random.default_rng(seed)
+    fids = rng.choice(10 * n_fields, size=n_fields, replace=False)
+    data = {fid: rng.uniform(-1, 1, size=(rng.integers(1, 2 * patches_per_field), num_dates, 2, 3, 3))
+            for fid in fids}
+    labels = pd.get_dummies(pd.Series(rng.integers(n_classes, size=n_fields), index=fids)).astype(int)
+    return data, labels
+
+def synthetic_genotypes(n_samples, n_loci, missing=0.05, seed=42):
+    # Sample-major codes of 0, 1 and 2 alternate alleles, as returned by encode_genotypes
+    from hpc4ag.snp import MissingCode
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(3, size=(n_samples, n_loci), dtype=np.int8)
+    codes[rng.random((n_samples, n_loci)) < missing] = MissingCode
+    return {'codes': codes, 'values': np.array([0., 1., 2.]),
+            'samples': ['S{}'.format(s) for s in range(n_samples)]}
+
+def random_sequence(length, seed=42):
+    rng = np.random.default_rng(seed)
+    return np.frombuffer(b'ACGT', dtype=np.uint8)[rng.integers(4, size=length)].tobytes()
+
+# Each benchmark builds its input in workdir and returns the function to time, the number of
+# items it processes per call, their unit, the hpc4ag functions to line-profile and its parameters
+
+def bench_divide_image(scale, workdir, num_processors, allow_overlap=False):
+    from hpc4ag.preprocessing import divide_image, patch_origins
+    side = max(3, round(300 * math.sqrt(scale)))
+    array = synthetic_field(side, side)
+    n_patches = len(patch_origins(array, allow_overlap=allow_overlap)[0])
+    return (lambda: divide_image(array, allow_overlap=allow_overlap), n_patches, 'patches',
+            [divide_image, patch_origins], {'shape': list(array.shape), 'allow_overlap': allow_overlap})
+
+def bench_divide_image_overlap(scale, workdir, num_processors):
+    return bench_divide_image(scale, workdir, num_processors, allow_overlap=True)
+
+def bench_get_analysis_array(scale, workdir, num_processors, convert=False):
+    from hpc4ag.preprocessing import get_analysis_array, sample_analysis_array, load_sample, convert_sample
+    from hpc4ag.utils import save_pickle
+    side = max(3, round(200 * math.sqrt(scale)))
+    sample = synthetic_sample(side, side)
+    filepath = os.path.join(workdir, 'sample.pkl')
+    save_pickle(sample, filepath)
+    if convert:
+        convert_sample(filepath, os.path.join(workdir, 'sample'))
+        filepath = os.path.join(workdir, 'sample')
+    num_dates, _, height, width = sample['samples'][0]['grids'][0]['stack'].shape
+    return (lambda: get_analysis_array(filepath), num_dates * height * width, 'pixels',
+            [get_analysis_array, sample_analysis_array, load_sample],
+            {'shape': [num_dates, len(Bands), height, width], 'format': 'npy' if convert else 'pickle'})
+
+def bench_get_analysis_array_npy(scale, workdir, num_processors):
+    return bench_get_analysis_array(scale, workdir, num_processors, convert=True)
+
+def bench_generate_X_and_y(scale, workdir, num_processors):
+    from hpc4ag.modeling import generate_X_and_y
+    data, labels = synthetic_patches(max(1, round(200 * scale)), 50)
+    n_patches = sum(len(patches) for patches in data.values())
+    return (lambda: generate_X_and_y(data, labels), n_patches, 'patches',
+            [generate_X_and_y], {'fields': len(data)})
+
+def bench_container_X_and_y(scale, workdir, num_processors):
+    from hpc4ag.modeling import container_X_and_y
+    from hpc4ag.preprocessing import save_patch_container, load_patch_container, select_fields
+    data, labels = synthetic_patches(max(1, round(200 * scale)), 50)
+    outpath = os.path.join(workdir, 'patches')
+    save_patch_container(data, outpath)
+    container = load_patch_container(outpath)
+    fids = list(data.keys())
+    n_patches = sum(len(patches) for patches in data.values())
+    return (lambda: np.asarray(container_X_and_y(container, labels, fids)[0]).sum(), n_patches, 'patches',
+            [container_X_and_y, select_fields], {'fields': len(data)})
+
+def bench_apply_scaler_train(scale, workdir, num_processors):
+    from hpc4ag.modeling import apply_scaler_train, fit_scaler, transform_scaler
+    rng = np.random.default_rng(42)
+    X = rng.uniform(-1, 15, size=(max(1, round(20000 * scale)), 31, 2, 3, 3))
+    return (lambda: apply_scaler_train(X), len(X), 'patches',
+            [apply_scaler_train, fit_scaler, transform_scaler], {'shape': list(X.shape)})
+
+def bench_snp_pairwise(scale, workdir, num_processors, packed=False):
+    from hpc4ag.snp import pairwise_distances, pack_codes, block_counts, pairwise_block, unpack_codes
+    genotypes = synthetic_genotypes(max(2, round(500 * math.sqrt(scale))), 10000)
+    n_samples, n_loci = genotypes['codes'].shape
+    if packed:
+        lo, hi, valid = pack_codes(genotypes['codes'])
+        genotypes = {'lo': lo, 'hi': hi, 'valid': valid, 'samples': genotypes['samples'], 'n_loci': n_loci}
+    return (lambda: pairwise_distances(genotypes, num_processors=num_processors), n_samples * (n_samples - 1) // 2,
+            'pairs', [pairwise_distances, block_counts, pairwise_block] + ([unpack_codes] if packed else []),
+            {'samples': n_samples, 'loci': n_loci, 'packed': packed})
+
+def bench_snp_pairwise_packed(scale, workdir, num_processors):
+    return bench_snp_pairwise(scale, workdir, num_processors, packed=True)
+
+def bench_snp_packed_kernel(scale, workdir, num_processors):
+    # One 256 x 256 tile through the popcount kernel, to compare with the dense kernel block_counts uses
+    from hpc4ag.snp import pack_codes, block_counts, packed_pairwise_block, popcount
+    genotypes = synthetic_genotypes(512, max(64, round(42000 * scale)))
+    n_loci = genotypes['codes'].shape[1]
+    lo, hi, valid = pack_codes(genotypes['codes'])
+    genotypes = {'lo': lo, 'hi': hi, 'valid': valid, 'samples': genotypes['samples'], 'n_loci': n_loci}
+    return (lambda: block_counts(genotypes, 0, 256, 256, 512, kernel='packed'), 256 * 256, 'pairs',
+            [packed_pairwise_block, popcount], {'loci': n_loci, 'bitwise_count': hasattr(np, 'bitwise_count')})
+
+def bench_count_kmers(scale, workdir, num_processors):
+    from hpc4ag.kmers import count_kmers, kmer_values, count_values
+    text = random_sequence(max(12, round(10 ** 7 * scale)))
+    return (lambda: count_kmers(text, 12), len(text), 'bases',
+            [count_kmers, kmer_values, count_values], {'length': len(text), 'k': 12})
+
+def bench_count_kmers_parallel(scale, workdir, num_processors):
+    from hpc4ag.kmers import count_kmers_parallel, merge_counts
+    filepaths = []
+    length = max(21, round(10 ** 7 * scale))
+    for chrom in range(2):
+        filepaths.append(os.path.join(workdir, 'chr{}.fa'.format(chrom + 1)))
+        text = random_sequence(length, seed=chrom)
+        with open(filepaths[-1], 'wb') as f:
+            f.write('>chr{}\n'.format(chrom + 1).encode())
+            for start in range(0, len(text), 60):
+                f.write(text[start:start+60] + b'\n')
+    return (lambda: count_kmers_parallel(filepaths, 21, chunk_size=1 << 22, num_processors=num_processors),
+            2 * length, 'bases', [count_kmers_parallel, merge_counts], {'length': 2 * length, 'k': 21})
+
+benchmarks = {name[len('bench_'):]: function for name, function in list(globals().items()) if name.startswith('bench_')}
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS; for RUSAGE_CHILDREN it is the largest worker
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+def profile_run(run, targets, profile, outfile):
+    if profile == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+        profiler.dump_stats(outfile + '.prof')
+        return outfile + '.prof'
+    try:
+        from line_profiler import LineProfiler
+    except ImportError:
+        raise ImportError("--profile line needs the line_profiler package (pip install line_profiler)")
+    profiler = LineProfiler(*targets)
+    profiler.runcall(run)
+    with open(outfile + '.lprof.txt', 'w') as f:
+        profiler.print_stats(stream=f)
+    return outfile + '.lprof.txt'
+
+def measure(name, scale=1, repeat=3, num_processors=1, profile=None, workdir=None, profile_dir='.'):
+    """
+    Runs one benchmark in the current process.
+
+    Parameters:
+        name (str): Name of the benchmark (see benchmarks).
+        scale (float, optional): Size multiplier of the synthetic input. Defaults to 1.
+        repeat (int, optional): Number of timed calls. Defaults to 3.
+        num_processors (int, optional): Number of worker processes of parallel benchmarks. Defaults to 1.
+        profile (str, optional): None, "cprofile" or "line". Defaults to None.
+        workdir (str, optional): Directory for the input files. Defaults to None (system temporary directory).
+        profile_dir (str, optional): Directory for profiler output. Defaults to the current directory.
+
+    Returns:
+        dict: Timings (s), throughput (items per second of the fastest call), RSS after setup, peak RSS
+            and peak RSS of the largest worker process (MB).
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        run, n_items, unit, targets, params = benchmarks[name](scale, tmp, num_processors)
+        setup_rss = peak_rss_mb()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        result = {'name': name, 'params': params, 'items': n_items, 'unit': unit, 'times': times,
+                  'best': min(times), 'mean': float(np.mean(times)),
+                  'throughput': n_items / min(times), 'throughput_unit': unit + '/s',
+                  'setup_rss_mb': setup_rss, 'peak_rss_mb': peak_rss_mb(),
+                  'worker_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+        if profile is not None:
+            result['profile'] = profile_run(run, targets, profile, os.path.join(profile_dir, name))
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {'commit': git_commit(), 'host': socket.gethostname(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpu_count': os.cpu_count(),
+            'available_cpus': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+            'slurm_job_id': os.environ.get('SLURM_JOB_ID'),
+            'date': datetime.datetime.now().isoformat(timespec='seconds')}
+
+def run_benchmarks(names, scale=1, repeat=3, num_processors=1, profile=None, workdir=None, profile_dir='.'):
+    """
+    Runs benchmarks one after another, each in a fresh process.
+
+    Parameters:
+        names (list of str): Names of the benchmarks.
+        (other parameters as in measure)
+
+    Returns:
+        dict: Run with keys environment, settings and results.
+    """
+    results = []
+    for name in names:
+        # A spawned process starts without the memory of earlier benchmarks
+        with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+            result = pool.submit(measure, name, scale, repeat, num_processors, profile, workdir, profile_dir).result()
+        print("{:28s} {:9.4f} s  {:12.4g} {:10s}  peak RSS {:8.1f} MB".format(
+            name, result['best'], result['throughput'], result['throughput_unit'], result['peak_rss_mb']), flush=True)
+        results.append(result)
+    return {'environment': environment(),
+            'settings': {'scale': scale, 'repeat': repeat, 'num_processors': num_processors, 'profile': profile},
+            'results': results}
+
+def compare(old_file, new_file):
+    """
+    Prints the throughput and peak RSS of two runs side by side.
+
+    Parameters:
+        old_file, new_file (str): JSON files written by run_benchmarks.
+
+    Returns:
+        None
+    """
+    runs = []
+    for filepath in [old_file, new_file]:
+        with open(filepath) as f:
+            runs.append(json.load(f))
+    old = {result['name']: result for result in runs[0]['results']}
+    print("{:28s} {:>12s} {:>12s} {:>8s} {:>10s} {:>10s}".format(
+        'benchmark', 'old', 'new', 'speedup', 'old RSS', 'new RSS'))
+    for result in runs[1]['results']:
+        if result['name'] not in old:
+            continue
+        before = old[result['name']]
+        print("{:28s} {:12.4g} {:12.4g} {:7.2f}x {:10.1f} {:10.1f}".format(
+            result['name'], before['throughput'], result['throughput'], result['throughput'] / before['throughput'],
+            before['peak_rss_mb'], result['peak_rss_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the hpc4ag hot paths on synthetic data.")
+    parser.add_argument('--scale', type=float, default=1, help="size multiplier of the synthetic inputs")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed calls per benchmark")
+    parser.add_argument('--processors', type=int, default=1, help="worker processes of the parallel benchmarks")
+    parser.add_argument('--only', nargs='+', choices=sorted(benchmarks), help="benchmarks to run (default all)")
+    parser.add_argument('--profile', choices=['cprofile', 'line'], help="profile one extra call of each benchmark")
+    parser.add_argument('--workdir', help="directory for synthetic input files, for example node-local scratch")
+    parser.add_argument('--output', help="JSON file for the results (default benchmark-<commit>-p<processors>.json)")
+    parser.add_argument('--list', action='store_true', help="list the benchmarks and exit")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files and exit")
+    args = parser.parse_args()
+    if args.list:
+        print('\n'.join(benchmarks))
+        sys.exit()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    output = args.output or 'benchmark-{}-p{}.json'.format(git_commit() or 'unknown', args.processors)
+    profile_dir = os.path.dirname(os.path.abspath(output))
+    run = run_benchmarks(args.only or list(benchmarks), args.scale, args.repeat, args.processors,
+                         args.profile, args.workdir, profile_dir)
+    write_json(run, output)
+    print("Results written to {}".format(output))
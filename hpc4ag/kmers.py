@@ -0,0 +1,346 @@
+import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+Bases = 'ACGT'
+InvalidCode = 4
+# Largest k counted with a dense bincount table of 4**k entries
+DenseMaxK = 12
+MaxK = 32
+
+_base_codes = np.full(256, InvalidCode, dtype=np.uint8)
+for _code, _base in enumerate(Bases):
+    _base_codes[ord(_base)] = _code
+    _base_codes[ord(_base.lower())] = _code
+
+def encode_sequence(text):
+    """
+    Encodes a DNA sequence as 2-bit base codes (A=0, C=1, G=2, T=3).
+
+    Parameters:
+        text (str or bytes): DNA sequence. Lower case is accepted; any other letter (N, IUPAC codes) is invalid.
+
+    Returns:
+        array: uint8 array of base codes, InvalidCode for bases other than A, C, G and T.
+    """
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    return _base_codes[np.frombuffer(text, dtype=np.uint8)]
+
+def decode_kmer(value, k):
+    """
+    Decodes a 2-bit encoded k-mer back into its string.
+
+    Parameters:
+        value (int): Encoded k-mer.
+        k (int): Length of the k-mer.
+
+    Returns:
+        str: The k-mer.
+    """
+    value = int(value)
+    return ''.join(Bases[(value >> (2 * (k - 1 - p))) & 3] for p in range(k))
+
+def kmer_values(codes, k, canonical=False):
+    """
+    Computes the rolling 2-bit encoding of every k-mer of a sequence, skipping k-mers
+    that contain an invalid base.
+
+    Parameters:
+        codes (array): Base codes as returned by encode_sequence.
+        k (int): Length of the k-mers (at most 32).
+        canonical (bool, optional): Encode each k-mer as the smaller of itself and its reverse
+            complement. Defaults to False.
+
+    Returns:
+        array: uint64 encoded k-mers, in sequence order.
+    """
+    if not 1 <= k <= MaxK:
+        raise ValueError("k must be between 1 and {}".format(MaxK))
+    n_windows = len(codes) - k + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    # Windows with an invalid base have a non-zero count of invalid codes
+    invalid = np.concatenate([[0], np.cumsum(codes == InvalidCode)])
+    valid = invalid[k:] == invalid[:-k]
+    bases = (codes & 3).astype(np.uint64)
+    values = np.zeros(n_windows, dtype=np.uint64)
+    for p in range(k):
+        values <<= np.uint64(2)
+        values |= bases[p:p+n_windows]
+    if canonical:
+        # The reverse complement has the complement of base p in bits 2p and 2p+1
+        reverse = np.zeros(n_windows, dtype=np.uint64)
+        for p in range(k):
+            reverse |= (np.uint64(3) - bases[p:p+n_windows]) << np.uint64(2 * p)
+        np.minimum(values, reverse, out=values)
+    return values[valid]
+
+def count_values(values, k):
+    """
+    Counts encoded k-mers, with a dense bincount table for small k and a sort otherwise.
+
+    Parameters:
+        values (array): Encoded k-mers as returned by kmer_values.
+        k (int): Length of the k-mers.
+
+    Returns:
+        array, array: Sorted distinct encoded k-mers (uint64), their counts (int64).
+    """
+    if k <= DenseMaxK:
+        counts = np.bincount(values.astype(np.intp), minlength=4**k)
+        kmers = np.flatnonzero(counts)
+        return kmers.astype(np.uint64), counts[kmers].astype(np.int64)
+    kmers, counts = np.unique(values, return_counts=True)
+    return kmers, counts.astype(np.int64)
+
+def merge_counts(parts):
+    """
+    Merges count tables of distinct k-mers, for example from chunks of a sequence.
+
+    Parameters:
+        parts (list of tuple): Count tables as (kmers, counts) pairs returned by count_kmers.
+
+    Returns:
+        array, array: Sorted distinct encoded k-mers (uint64), their summed counts (int64).
+    """
+    kmers = np.concatenate([np.zeros(0, dtype=np.uint64)] + [part[0] for part in parts])
+    counts = np.concatenate([np.zeros(0, dtype=np.int64)] + [part[1] for part in parts])
+    if len(kmers) == 0:
+        return kmers, counts
+    # The tables are sorted runs, which the stable sort (timsort) detects and merges in one pass each
+    # instead of sorting from scratch: O(n log(len(parts))) rather than O(n log n)
+    order = np.argsort(kmers, kind='stable')
+    kmers = kmers[order]
+    # Sum the counts of each run of equal k-mers
+    starts = np.flatnonzero(np.concatenate([[True], kmers[1:] != kmers[:-1]]))
+    return kmers[starts], np.add.reduceat(counts[order], starts)
+
+MergeFanIn = 8
+
+def _push_counts(stack, table):
+    # Adds a table to a stack of merged tables: every MergeFanIn tables of one level are merged into one
+    # table of the next level, so a k-mer takes part in log(chunks, MergeFanIn) merges instead of one per chunk
+    stack.append((0, table))
+    level = 0
+    while len(stack) >= MergeFanIn and all(entry[0] == level for entry in stack[-MergeFanIn:]):
+        merged = merge_counts([entry[1] for entry in stack[-MergeFanIn:]])
+        del stack[-MergeFanIn:]
+        level += 1
+        stack.append((level, merged))
+
+def _collapse_counts(stack):
+    table = merge_counts([table for _, table in stack])
+    stack.clear()
+    return table
+
+def count_kmers(text, k, canonical=False):
+    """
+    Counts the k-mers of a DNA sequence held in memory.
+
+    Parameters:
+        text (str, bytes or array): DNA sequence, or base codes as returned by encode_sequence.
+        k (int): Length of the k-mers (at most 32).
+        canonical (bool, optional): Count a k-mer and its reverse complement together. Defaults to False.
+
+    Returns:
+        array, array: Sorted distinct encoded k-mers (uint64), their counts (int64).
+    """
+    codes = text if isinstance(text, np.ndarray) else encode_sequence(text)
+    return count_values(kmer_values(codes, k, canonical), k)
+
+def iter_fasta_chunks(filepath, k, chunk_size=1 << 24):
+    """
+    Streams the sequences of a FASTA file in chunks that overlap by k-1 bases, so that
+    every k-mer of a record is in exactly one chunk.
+
+    Parameters:
+        filepath (str): The path to the FASTA file.
+        k (int): Length of the k-mers.
+        chunk_size (int, optional): Approximate number of bases per chunk. Defaults to 2**24.
+
+    Yields:
+        str, bytes: Record name, chunk of its sequence.
+    """
+    name = None
+    pieces = []
+    size = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None and size >= k:
+                    yield name, b''.join(pieces)
+                name = line[1:].strip().decode()
+                pieces, size = [], 0
+                continue
+            line = line.strip()
+            pieces.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                chunk = b''.join(pieces)
+                yield name, chunk
+                pieces = [chunk[len(chunk)-k+1:]] if k > 1 else []
+                size = len(pieces[0]) if pieces else 0
+    if name is not None and size >= k:
+        yield name, b''.join(pieces)
+
+def count_kmers_fasta(filepath, k, canonical=False, chunk_size=1 << 24):
+    """
+    Counts the k-mers of every sequence of a FASTA file, streaming it in chunks.
+
+    Parameters:
+        filepath (str): The path to the FASTA file.
+        k (int): Length of the k-mers (at most 32).
+        canonical (bool, optional): Count a k-mer and its reverse complement together. Defaults to False.
+        chunk_size (int, optional): Approximate number of bases per chunk. Defaults to 2**24.
+
+    Returns:
+        array, array: Sorted distinct encoded k-mers (uint64), their counts (int64).
+    """
+    stack = []
+    for _, chunk in iter_fasta_chunks(filepath, k, chunk_size):
+        _push_counts(stack, count_kmers(chunk, k, canonical))
+    return _collapse_counts(stack)
+
+def top_kmers(kmers, counts, k, n=10):
+    """
+    Reports the most frequent k-mers of a count table.
+
+    Parameters:
+        kmers (array): Sorted distinct encoded k-mers.
+        counts (array): Their counts.
+        k (int): Length of the k-mers.
+        n (int, optional): Number of k-mers to report. Defaults to 10.
+
+    Returns:
+        list of tuple: (k-mer, count) pairs by decreasing count, ties in alphabetical order.
+    """
+    order = np.lexsort((kmers, -counts))[:n]
+    return [(decode_kmer(kmers[i], k), int(counts[i])) for i in order]
+
+def frequent_words(text, k, canonical=False):
+    """
+    Finds the most frequent k-mers of a DNA sequence, like FrequentWords and BetterFrequentWords
+    in the Profile-kmers notebook.
+
+    Parameters:
+        text (str): DNA sequence.
+        k (int): Length of the k-mers (at most 32).
+        canonical (bool, optional): Count a k-mer and its reverse complement together. Defaults to False.
+
+    Returns:
+        list of str: The k-mers that occur most often, in alphabetical order.
+    """
+    kmers, counts = count_kmers(text, k, canonical)
+    if len(counts) == 0:
+        return []
+    return [decode_kmer(kmer, k) for kmer in kmers[counts == counts.max()]]
+
+def _count_chunk(args):
+    chunk, k, canonical = args
+    return count_kmers(chunk, k, canonical)
+
+def spill_counts(kmers, counts, spill_dir, run):
+    """
+    Writes a sorted count table to disk as one run of a spilled count.
+
+    Parameters:
+        kmers (array): Sorted distinct encoded k-mers.
+        counts (array): Their counts.
+        spill_dir (str): Directory of the spilled runs.
+        run (int): Index of the run.
+
+    Returns:
+        str, str: Paths of the k-mer and count files of the run.
+    """
+    files = (os.path.join(spill_dir, 'run_{}_kmers.npy'.format(run)),
+             os.path.join(spill_dir, 'run_{}_counts.npy'.format(run)))
+    np.save(files[0], kmers)
+    np.save(files[1], counts)
+    return files
+
+def merge_runs(runs, k, outdir, num_buckets=64):
+    """
+    Merges spilled count runs into one sorted count table on disk. The k-mer space is split into
+    buckets and only one bucket of every run is in memory at a time.
+
+    Parameters:
+        runs (list of tuple): Paths of the k-mer and count files of each run, as returned by spill_counts.
+        k (int): Length of the k-mers.
+        outdir (str): Directory where kmers.u64 and counts.i64 are written.
+        num_buckets (int, optional): Number of buckets of the k-mer space. Defaults to 64.
+
+    Returns:
+        array, array: Memory-mapped sorted distinct encoded k-mers (uint64) and their counts (int64).
+    """
+    tables = [(np.load(kmer_file, mmap_mode='r'), np.load(count_file, mmap_mode='r')) for kmer_file, count_file in runs]
+    bounds = [np.uint64(4**k * b // num_buckets) for b in range(num_buckets)] + [None]
+    n_kmers = 0
+    with open(os.path.join(outdir, 'kmers.u64'), 'wb') as kmer_out, open(os.path.join(outdir, 'counts.i64'), 'wb') as count_out:
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            parts = []
+            for kmers, counts in tables:
+                start = np.searchsorted(kmers, low)
+                stop = len(kmers) if high is None else np.searchsorted(kmers, high)
+                parts.append((np.asarray(kmers[start:stop]), np.asarray(counts[start:stop])))
+            kmers, counts = merge_counts(parts)
+            kmers.tofile(kmer_out)
+            counts.tofile(count_out)
+            n_kmers += len(kmers)
+    if n_kmers == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    return (np.memmap(os.path.join(outdir, 'kmers.u64'), dtype=np.uint64, mode='r', shape=(n_kmers,)),
+            np.memmap(os.path.join(outdir, 'counts.i64'), dtype=np.int64, mode='r', shape=(n_kmers,)))
+
+def count_kmers_parallel(filepaths, k, canonical=False, chunk_size=1 << 24, num_processors=1,
+                         spill_dir=None, spill_size=1 << 26):
+    """
+    Counts the k-mers of whole genomes in a process pool. Every sequence is split into chunks
+    that overlap by k-1 bases, each chunk is counted into a compact sorted table, and the tables
+    are merged in batches of MergeFanIn sorted runs. At most 2*num_processors chunks are in flight,
+    but without spill_dir the merged tables stay in memory, so peak memory grows with the number of
+    distinct k-mers (about 70 bytes per distinct k-mer at peak for 40 Mb at k=21). With spill_dir the merged
+    tables are written to disk whenever they exceed spill_size distinct k-mers, which bounds peak memory.
+
+    Parameters:
+        filepaths (str or list of str): FASTA file(s), for example one file per chromosome.
+        k (int): Length of the k-mers (at most 32).
+        canonical (bool, optional): Count a k-mer and its reverse complement together. Defaults to False.
+        chunk_size (int, optional): Approximate number of bases per chunk. Defaults to 2**24.
+        num_processors (int, optional): Number of worker processes. Defaults to 1.
+        spill_dir (str, optional): Directory for spilled runs and the merged table. Defaults to None (no spill).
+        spill_size (int, optional): Distinct k-mers held in memory before spilling. Defaults to 2**26.
+
+    Returns:
+        array, array: Sorted distinct encoded k-mers (uint64), their counts (int64); memory-mapped
+            when spill_dir is given.
+    """
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    chunks = ((chunk, k, canonical) for filepath in filepaths
+              for _, chunk in iter_fasta_chunks(filepath, k, chunk_size))
+    stack = []
+    runs = []
+    def add(table):
+        _push_counts(stack, table)
+        if spill_dir is not None and sum(len(kmers) for _, (kmers, _) in stack) > spill_size:
+            os.makedirs(spill_dir, exist_ok=True)
+            runs.append(spill_counts(*_collapse_counts(stack), spill_dir, len(runs)))
+    if num_processors <= 1:
+        for args in chunks:
+            add(_count_chunk(args))
+    else:
+        with ProcessPoolExecutor(num_processors) as pool:
+            pending = deque()
+            for args in chunks:
+                pending.append(pool.submit(_count_chunk, args))
+                if len(pending) >= 2 * num_processors:
+                    add(pending.popleft().result())
+            while pending:
+                add(pending.popleft().result())
+    if spill_dir is None:
+        return _collapse_counts(stack)
+    os.makedirs(spill_dir, exist_ok=True)
+    runs.append(spill_counts(*_collapse_counts(stack), spill_dir, len(runs)))
+    return merge_runs(runs, k, spill_dir)
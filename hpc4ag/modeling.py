@@ -1,10 +1,17 @@
+import os
+import json
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Reshape, Flatten, LSTM, Dense, Dropout, SimpleRNN
 from tensorflow.keras import regularizers
 from tensorflow.keras.optimizers import Adam
 from sklearn.utils.class_weight import compute_class_weight
-from sklearn.preprocessing import MinMaxScaler
+
+from .utils import cached_file, load_pickle
+from .preprocessing import get_analysis_array, patch_origins, divide_image, select_fields, load_patch_container
 
 def generate_X_and_y(data, one_hot_encoded_labels):
     """
@@ -27,6 +34,121 @@ def generate_X_and_y(data, one_hot_encoded_labels):
     y = np.array(y)
     return X, y
 
+def container_X_and_y(container, one_hot_encoded_labels, fids):
+    """
+    Pairs the patches of some fields of a patch container with their labels. X is a view of the
+    memory-mapped patches when the fields are stored contiguously.
+
+    Parameters:
+        container (dict): Patch container as returned by hpc4ag.preprocessing.load_patch_container.
+        one_hot_encoded_labels (pandas.DataFrame): Data frame with one hot encoded representation of different categories for each field ID.
+        fids (list of int): IDs of the fields to select.
+
+    Returns:
+        array, array: Array with patches, array with labels
+    """
+    X, field_of_patch = select_fields(container, fids)
+    y = one_hot_encoded_labels.loc[list(fids)].to_numpy()[field_of_patch]
+    return X, y
+
+def iter_patches_and_labels(patch_files, one_hot_encoded_labels):
+    """
+    Streams patches and their labels from saved patch files, holding one file at a time.
+
+    Parameters:
+        patch_files (list of str): Paths to pickle files with dictionaries of field IDs and corresponding patches.
+        one_hot_encoded_labels (pandas.DataFrame): Data frame with one hot encoded representation of different categories for each field ID.
+
+    Yields:
+        array, array: float32 patch, float32 label.
+    """
+    for patch_file in patch_files:
+        data = load_pickle(patch_file)
+        for fid in data.keys():
+            # Look up the label once per field instead of once per patch
+            label = one_hot_encoded_labels.loc[fid].to_numpy(dtype=np.float32)
+            for patch in data[fid]:
+                yield patch.astype(np.float32), label
+        del data
+
+def iter_container_batches(container, one_hot_encoded_labels, fids=None, batch_size=32, shuffle=True):
+    """
+    Streams batches of patches and labels from a memory-mapped patch container, reading one batch
+    of patches at a time. With shuffle, every pass draws a new permutation of all patches.
+
+    Parameters:
+        container (dict): Patch container as returned by hpc4ag.preprocessing.load_patch_container.
+        one_hot_encoded_labels (pandas.DataFrame): Data frame with one hot encoded representation of different categories for each field ID.
+        fids (list of int, optional): IDs of the fields to stream. Defaults to None (all fields of the container).
+        batch_size (int, optional): Number of patches per batch. Defaults to 32.
+        shuffle (bool, optional): Shuffle the patches of all fields. Defaults to True.
+
+    Yields:
+        array, array: float32 batch of patches, float32 batch of labels.
+    """
+    fids = list(container['fids']) if fids is None else list(fids)
+    position = {fid: k for k, fid in enumerate(container['fids'])}
+    ks = np.array([position[fid] for fid in fids], dtype=int)
+    offsets = container['offsets']
+    rows = np.concatenate([np.zeros(0, dtype=int)] + [np.arange(offsets[k], offsets[k + 1]) for k in ks])
+    labels = one_hot_encoded_labels.loc[fids].to_numpy(dtype=np.float32)[
+        np.repeat(np.arange(len(ks)), offsets[ks + 1] - offsets[ks])]
+    order = np.random.default_rng().permutation(len(rows)) if shuffle else np.arange(len(rows))
+    for start in range(0, len(order), batch_size):
+        # Reading the rows of a batch in file order is kinder to the page cache
+        batch = np.sort(order[start:start+batch_size])
+        yield np.asarray(container['patches'][rows[batch]], dtype=np.float32), labels[batch]
+
+def make_dataset(patches, one_hot_encoded_labels, scalers=None, batch_size=32, shuffle_buffer=10000,
+                 fids=None, patch_shape=None):
+    """
+    Builds a tf.data pipeline that streams patches, scales them on the fly and prefetches batches
+    for model.fit. From a patch container (see hpc4ag.preprocessing.save_patch_container) only one
+    batch is read at a time, so memory is bounded by the batch size. From pickled patch files one
+    whole file is held at a time, plus the shuffle buffer.
+
+    Parameters:
+        patches (dict, str or list of str): Patch container as returned by load_patch_container, the
+            directory of a container, or paths to pickle files with dictionaries of field IDs and corresponding patches.
+        one_hot_encoded_labels (pandas.DataFrame): Data frame with one hot encoded representation of different categories for each field ID.
+        scalers (dict, optional): Fitted scaler as returned by apply_scaler_train. Defaults to None (no scaling).
+        batch_size (int, optional): Number of patches per batch. Defaults to 32.
+        shuffle_buffer (int, optional): 0 keeps the stored (field) order. Patches of a container are
+            shuffled across all fields every epoch for any other value; patches of pickle files are
+            shuffled through a buffer of this size. Defaults to 10000.
+        fids (list of int, optional): IDs of the fields of a container to use. Defaults to None (all fields).
+        patch_shape (tuple of int, optional): Shape of one patch, for example (31, 2, 3, 3). Read from a container;
+            for pickle files, pass it to avoid unpickling the first file an extra time. Defaults to None.
+
+    Returns:
+        tf.data.Dataset: Dataset of (patches, labels) batches.
+    """
+    n_classes = one_hot_encoded_labels.shape[1]
+    if isinstance(patches, str) and os.path.isdir(patches):
+        patches = load_patch_container(patches)
+    if isinstance(patches, dict):
+        container = patches
+        patch_shape = container['patches'].shape[1:]
+        dataset = tf.data.Dataset.from_generator(
+            lambda: iter_container_batches(container, one_hot_encoded_labels, fids, batch_size, shuffle_buffer > 0),
+            output_signature=(tf.TensorSpec((None,) + tuple(patch_shape), tf.float32),
+                              tf.TensorSpec((None, n_classes), tf.float32)))
+    else:
+        patch_files = [patches] if isinstance(patches, str) else list(patches)
+        if patch_shape is None:
+            patch_shape = next(iter_patches_and_labels(patch_files[:1], one_hot_encoded_labels))[0].shape
+        dataset = tf.data.Dataset.from_generator(
+            lambda: iter_patches_and_labels(patch_files, one_hot_encoded_labels),
+            output_signature=(tf.TensorSpec(tuple(patch_shape), tf.float32),
+                              tf.TensorSpec((n_classes,), tf.float32)))
+        if shuffle_buffer:
+            dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.batch(batch_size)
+    if scalers is not None:
+        scale, offset = [tf.constant(factor) for factor in scaler_params(scalers, len(patch_shape) + 1)]
+        dataset = dataset.map(lambda X, y: (X * scale + offset, y), num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
 def assign_class_weight(y):
     """
     Computes class weight to balance out under- and over-represented classes in the training set.
@@ -44,46 +166,139 @@ def assign_class_weight(y):
     return dict(zip(class_labels, class_weights))
 
 
+def partial_fit_scaler(scaler, X, channel_axis=2):
+    """
+    Updates a channel-wise min/max scaler with a chunk of data, so it can be fitted over
+    data that does not fit in memory at once.
+
+    Parameters:
+        scaler (dict): Scaler as returned by a previous call, or None to start a new one.
+        X (array): Chunk of data, for example patches of shape (patches, time, channel, row, column).
+        channel_axis (int, optional): Axis of the channels. Defaults to 2.
+
+    Returns:
+        dict: Scaler with keys data_min, data_max (one value per channel) and channel_axis.
+    """
+    axes = tuple(axis for axis in range(X.ndim) if axis != channel_axis % X.ndim)
+    data_min = np.nanmin(X, axis=axes)
+    data_max = np.nanmax(X, axis=axes)
+    if scaler is not None:
+        data_min = np.minimum(data_min, scaler['data_min'])
+        data_max = np.maximum(data_max, scaler['data_max'])
+    return {'data_min': data_min, 'data_max': data_max, 'channel_axis': channel_axis}
+
+def fit_scaler(X, channel_axis=2):
+    """
+    Fits a channel-wise min/max scaler for any number of channels.
+
+    Parameters:
+        X (array): Data, for example patches of shape (patches, time, channel, row, column).
+        channel_axis (int, optional): Axis of the channels. Defaults to 2.
+
+    Returns:
+        dict: Scaler with keys data_min, data_max (one value per channel) and channel_axis.
+    """
+    return partial_fit_scaler(None, X, channel_axis)
+
+def scaler_params(scaler, ndim, dtype=np.float32):
+    """
+    Returns the per-channel factors of a scaler, shaped to broadcast against the data
+    (MinMaxScaler scaling to [0, 1]: X * scale + offset).
+
+    Parameters:
+        scaler (dict): Fitted scaler.
+        ndim (int): Number of dimensions of the data.
+        dtype (dtype, optional): Data type of the factors. Defaults to float32.
+
+    Returns:
+        array, array: Scale and offset.
+    """
+    shape = [1] * ndim
+    shape[scaler['channel_axis']] = -1
+    data_min = np.asarray(scaler['data_min'], dtype=dtype)
+    data_range = np.asarray(scaler['data_max'], dtype=dtype) - data_min
+    # Constant channels are left unscaled, as MinMaxScaler does
+    data_range[data_range == 0] = 1
+    scale = 1 / data_range
+    return scale.reshape(shape), (-data_min * scale).reshape(shape)
+
+def transform_scaler(X, scaler, inplace=False):
+    """
+    Scales data to [0, 1] per channel with broadcasting.
+
+    Parameters:
+        X (array): Data with the layout the scaler was fitted on.
+        scaler (dict): Fitted scaler.
+        inplace (bool, optional): Scale X in place (X must have a float dtype). Defaults to False.
+
+    Returns:
+        array: Scaled data.
+    """
+    dtype = X.dtype if inplace else np.result_type(X.dtype, np.float32)
+    if not inplace:
+        X = X.astype(dtype)
+    scale, offset = scaler_params(scaler, X.ndim, dtype)
+    X *= scale
+    X += offset
+    return X
+
+def save_scaler(scaler, filepath):
+    """
+    Saves a fitted scaler to a JSON file, for example next to the model for inference jobs.
+
+    Parameters:
+        scaler (dict): Fitted scaler.
+        filepath (str): The path to the JSON file.
+
+    Returns:
+        None
+    """
+    with open(filepath, 'w') as f:
+        json.dump({'data_min': np.asarray(scaler['data_min']).tolist(),
+                   'data_max': np.asarray(scaler['data_max']).tolist(),
+                   'channel_axis': scaler['channel_axis']}, f)
+
+def load_scaler(filepath):
+    """
+    Loads a scaler saved with save_scaler.
+
+    Parameters:
+        filepath (str): The path to the JSON file.
+
+    Returns:
+        dict: Fitted scaler.
+    """
+    with open(filepath) as f:
+        scaler = json.load(f)
+    scaler['data_min'] = np.array(scaler['data_min'])
+    scaler['data_max'] = np.array(scaler['data_max'])
+    return scaler
+
 def apply_scaler_train(X_train):
     """
-    Fits scaler to each feature of train and transforms train data.
+    Fits a min/max scaler to each channel of train and transforms train data.
 
     Parameters:
         X_train (array): Array of train data with original values.
 
     Returns:
-        array, dict of objects: Scaled train data, dictionary of scaler objects (one for each channel)
+        array, dict: Scaled train data, fitted channel-wise scaler
     """ 
-    scaled_feature_arrays = []
-    scalers = {}
-    for feature in [0,1]:
-        scalers[feature] = MinMaxScaler()
-        X_train_feature = X_train[:,:,feature,:,:].reshape(-1,1)
-        X_train_feature_scaled = scalers[feature].fit_transform(X_train_feature)
-        X_train_feature_scaled = X_train_feature_scaled.reshape(X_train[:,:,feature,:,:].shape)
-        scaled_feature_arrays.append(X_train_feature_scaled)
-    X_train_scaled = np.stack(scaled_feature_arrays, axis=2)
-    return X_train_scaled, scalers
+    scalers = fit_scaler(X_train)
+    return transform_scaler(X_train, scalers), scalers
 
 def apply_scaler_test(X_test, scalers):
     """
-    Transforms test data with previously created scalers.
+    Transforms test data with a previously fitted scaler.
 
     Parameters:
         X_test (array): Array of test data with original values.
-        scalers (dict of objects): Dictionary of scaler objects (one for each channel)
+        scalers (dict): Fitted channel-wise scaler, as returned by apply_scaler_train.
 
     Returns:
         array: Scaled test data.
     """ 
-    scaled_feature_arrays = []
-    for feature in [0,1]:
-        X_test_feature = X_test[:,:,feature,:,:].reshape(-1,1)
-        X_test_feature_scaled = scalers[feature].transform(X_test_feature)
-        X_test_feature_scaled = X_test_feature_scaled.reshape(X_test[:,:,feature,:,:].shape)
-        scaled_feature_arrays.append(X_test_feature_scaled)
-    X_test_scaled = np.stack(scaled_feature_arrays, axis=2)
-    return X_test_scaled
+    return transform_scaler(X_test, scalers)
 
 def compile_model(shape=(31, 2, 3, 3), kind="SimpleRNN", n_classes=4):
     """
@@ -109,4 +324,123 @@ def compile_model(shape=(31, 2, 3, 3), kind="SimpleRNN", n_classes=4):
     # Compile the model
     optimizer = Adam(learning_rate=0.001)
     model.compile(optimizer=optimizer, loss="categorical_crossentropy", metrics=["accuracy"])
-    return model
\ No newline at end of file
+    return model
+
+def load_field(fid, filepath, patch_height=3, patch_width=3, allow_overlap=False, start_end_dates=None):
+    """
+    Downloads one field, computes its vegetation indices and divides them into patches.
+
+    Parameters:
+        fid (int): ID of the field.
+        filepath (str): File name pattern of the field pickles, formatted with the field ID.
+        patch_height (int, optional): height dimension in pixels of a resulting patch. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of a resulting patch. Defaults to 3.
+        allow_overlap (bool, optional): create overrlapping patches. Defaults to False (no overlap).
+        start_end_dates (list of str, optional): List containing start and end dates for analysis. Defaults to None (all dates).
+
+    Returns:
+        dict: Field with keys fid, shape (rows, columns), patches, rows and cols (top-left pixel of each patch).
+    """
+    with cached_file(filepath.format(fid), bucket_path='csb/') as localpath:
+        analysis_array = get_analysis_array(filepath=localpath, start_end_dates=start_end_dates)
+    rows, cols = patch_origins(analysis_array, patch_height, patch_width, allow_overlap)
+    return {'fid': fid, 'shape': analysis_array.shape[2:], 'rows': rows, 'cols': cols,
+            'patches': divide_image(analysis_array, patch_height, patch_width, allow_overlap)}
+
+def field_prediction(field, probabilities, patch_height=3, patch_width=3):
+    """
+    Aggregates per-patch class probabilities of a field into a field label and a per-pixel raster.
+
+    Parameters:
+        field (dict): Field as returned by load_field.
+        probabilities (array): Class probabilities of each patch of the field.
+        patch_height (int, optional): height dimension in pixels of the patches. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of the patches. Defaults to 3.
+
+    Returns:
+        dict: Prediction with keys fid, label (-1 without patches), probabilities (mean over patches)
+            and raster (label of each pixel, averaged over the patches covering it; -1 where none does).
+    """
+    n_classes = probabilities.shape[1]
+    pixel_probabilities = np.zeros(tuple(field['shape']) + (n_classes,), dtype=np.float32)
+    rows = field['rows'][:, None, None] + np.arange(patch_height)[None, :, None]
+    cols = field['cols'][:, None, None] + np.arange(patch_width)[None, None, :]
+    values = np.broadcast_to(probabilities[:, None, None, :], rows.shape[:1] + (patch_height, patch_width, n_classes))
+    np.add.at(pixel_probabilities, (rows, cols), values)
+    raster = np.argmax(pixel_probabilities, axis=2).astype(np.int16)
+    raster[pixel_probabilities.sum(axis=2) == 0] = -1
+    if len(probabilities) == 0:
+        return {'fid': field['fid'], 'label': -1, 'probabilities': np.full(n_classes, np.nan), 'raster': raster}
+    mean_probabilities = probabilities.mean(axis=0)
+    return {'fid': field['fid'], 'label': int(np.argmax(mean_probabilities)),
+            'probabilities': mean_probabilities, 'raster': raster}
+
+def iter_predictions(model, fids, filepath, scalers, patch_height=3, patch_width=3, allow_overlap=False,
+                     start_end_dates=["2022-05-11", "2022-10-09"], batch_size=4096, num_workers=4):
+    """
+    Classifies fields wall-to-wall. Fields are loaded in a thread pool while the model predicts,
+    and their patches are batched across fields into large predict calls.
+
+    Parameters:
+        model (keras.Model): Trained model.
+        fids (list of int): list of IDs to classify.
+        filepath (str): File name pattern of the field pickles, formatted with the field ID.
+        scalers (dict): Fitted scaler as returned by apply_scaler_train (or load_scaler).
+        patch_height (int, optional): height dimension in pixels of a patch. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of a patch. Defaults to 3.
+        allow_overlap (bool, optional): classify overlapping patches. Defaults to False (no overlap).
+        start_end_dates (list of str, optional): List containing start and end dates for analysis. Defaults to ["2022-05-11", "2022-10-09"].
+        batch_size (int, optional): Minimum number of patches per predict call. Defaults to 4096.
+        num_workers (int, optional): Number of fields loaded concurrently. Defaults to 4.
+
+    Yields:
+        dict: Prediction of each field (see field_prediction), in the order of fids.
+    """
+    def predict(fields):
+        patches = [field['patches'] for field in fields if len(field['patches'])]
+        probabilities = np.zeros((0, model.output_shape[-1]), dtype=np.float32)
+        if patches:
+            X = transform_scaler(np.concatenate(patches).astype(np.float32), scalers, inplace=True)
+            probabilities = model.predict(X, batch_size=batch_size, verbose=0)
+        offsets = np.cumsum([0] + [len(field['rows']) for field in fields])
+        for k, field in enumerate(fields):
+            yield field_prediction(field, probabilities[offsets[k]:offsets[k+1]], patch_height, patch_width)
+
+    options = (filepath, patch_height, patch_width, allow_overlap, start_end_dates)
+    with ThreadPoolExecutor(max(num_workers, 1)) as pool:
+        pending = deque()
+        fields = []
+        n_patches = 0
+        for fid in fids:
+            pending.append(pool.submit(load_field, fid, *options))
+            if len(pending) < 2 * max(num_workers, 1):
+                continue
+            fields.append(pending.popleft().result())
+            n_patches += len(fields[-1]['rows'])
+            if n_patches >= batch_size:
+                yield from predict(fields)
+                fields, n_patches = [], 0
+        while pending:
+            fields.append(pending.popleft().result())
+        yield from predict(fields)
+
+def predict_fields(model, fids, filepath, scalers, **kwargs):
+    """
+    Classifies fields wall-to-wall and collects the predictions.
+
+    Parameters:
+        model (keras.Model): Trained model.
+        fids (list of int): list of IDs to classify.
+        filepath (str): File name pattern of the field pickles, formatted with the field ID.
+        scalers (dict): Fitted scaler as returned by apply_scaler_train (or load_scaler).
+        **kwargs: Further arguments for iter_predictions.
+
+    Returns:
+        dict, dict: Field label of each field ID (-1 for fields without patches), per-pixel label raster of each field ID.
+    """
+    labels = {}
+    rasters = {}
+    for prediction in iter_predictions(model, fids, filepath, scalers, **kwargs):
+        labels[prediction['fid']] = prediction['label']
+        rasters[prediction['fid']] = prediction['raster']
+    return labels, rasters
@@ -1,8 +1,18 @@
+import os
+import json
+import bisect
 import pickle
+import multiprocessing
 import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from sklearn.model_selection import train_test_split
 
-from .utils import download_file, load_pickle, save_pickle
+from .utils import download_file, cached_file, load_pickle, save_pickle
+from .slurm import read_json, write_json, submit_array
 
 NoDataValue = -9999
 
@@ -33,36 +43,87 @@ def band_idx_lookup(band_name, data):
     """    
     return data['grid_info'][0]['bands'].index(band_name)
 
+def convert_sample(filepath, outpath):
+    """
+    Converts a pickled field sample into a directory of memory-mappable arrays
+    (stack.npy, mask.npy and meta.json with dates and band names).
+
+    Parameters:
+        filepath (str): The path to the pickle file with Sentinel data sample representing one field.
+        outpath (str): Directory where the sample is written.
+
+    Returns:
+        None
+    """
+    sr_data = load_pickle(filepath)
+    grid = sr_data['samples'][0]['grids'][0]
+    os.makedirs(outpath, exist_ok=True)
+    np.save(os.path.join(outpath, 'stack.npy'), grid['stack'])
+    np.save(os.path.join(outpath, 'mask.npy'), grid['mask'])
+    with open(os.path.join(outpath, 'meta.json'), 'w') as f:
+        json.dump({'dates': list(grid['dates']), 'bands': list(sr_data['grid_info'][0]['bands'])}, f)
+
+def load_sample(filepath, mmap_mode='r'):
+    """
+    Loads a field sample from a pickle file or from a directory written by convert_sample.
+    Arrays of a directory are memory-mapped, so band and date subsets are read lazily.
+
+    Parameters:
+        filepath (str): The path to the pickle file or to the sample directory.
+        mmap_mode (str, optional): Memory-map mode passed to numpy.load. Defaults to 'r'.
+
+    Returns:
+        dict: Sample with keys stack (dates, bands, rows, columns), mask, dates and bands.
+    """
+    if os.path.isdir(filepath):
+        with open(os.path.join(filepath, 'meta.json')) as f:
+            sample = json.load(f)
+        for key in ['stack', 'mask']:
+            sample[key] = np.load(os.path.join(filepath, key + '.npy'), mmap_mode=mmap_mode)
+        return sample
+    sr_data = load_pickle(filepath)
+    grid = sr_data['samples'][0]['grids'][0]
+    return {'stack': grid['stack'], 'mask': grid['mask'], 'dates': grid['dates'],
+            'bands': sr_data['grid_info'][0]['bands']}
+
 def get_analysis_array(filepath, start_end_dates=None):
     """
     Computes vegetation indices for crop type predictions (NDVI and CIre).
 
     Parameters:
-        filepath (str): The path to the pickle file with Sentinel data sample representing one field.
+        filepath (str): The path to the pickle file (or sample directory written by convert_sample)
+            with Sentinel data sample representing one field.
         start_end_dates (list of str, optional): List of start and end date for analysis,
             formatted as ["yyyy-mm-dd", "yyyy-mm-dd"]. Defaults to None (in that case all dates will be considered).
 
     Returns:
         array: stack of arrays with NDVI and CIre values for selected (or all) dates.
     """    
-    # Load data from the pickled file
-    sr_data = load_pickle(filepath)
-    # Extract relevant information from the loaded data
-    grid = sr_data['samples'][0]['grids'][0]
-    mask = grid['mask']
-    stack = grid['stack']
-    dates = grid['dates']
+    return sample_analysis_array(load_sample(filepath), start_end_dates)
+
+def sample_analysis_array(sample, start_end_dates=None):
+    """
+    Computes vegetation indices (NDVI and CIre) of a loaded field sample, reading only
+    the bands and dates they need.
+
+    Parameters:
+        sample (dict): Field sample as returned by load_sample.
+        start_end_dates (list of str, optional): List of start and end date for analysis. Defaults to None (all dates).
+
+    Returns:
+        array: stack of arrays with NDVI and CIre values for selected (or all) dates.
+    """
+    mask = np.asarray(sample['mask'])
+    stack = sample['stack']
+    dates = sample['dates']
     if start_end_dates != None:
         dates_selected = [
             dates.index(date) for date in dates if date >= start_end_dates[0] and date <= start_end_dates[1]
         ]
         stack = stack[dates_selected[0]:dates_selected[-1]+1,:,:,:]
-    # Extract specific bands from the stack
-    b4 = stack[:, band_idx_lookup("B04", sr_data), :, :]
-    b5 = stack[:, band_idx_lookup("B05", sr_data), :, :]
-    b7 = stack[:, band_idx_lookup("B07", sr_data), :, :]
-    b8 = stack[:, band_idx_lookup("B08", sr_data), :, :]
-    days2data = stack[:, band_idx_lookup("Days2data", sr_data), :, :]
+    # Extract specific bands from the stack (only these are read from a memory-mapped stack)
+    bands = [sample['bands'].index(band) for band in ["B04", "B05", "B07", "B08"]]
+    b4, b5, b7, b8 = np.moveaxis(stack[:, bands, :, :], 1, 0)
     # Calculate indices of interest
     ndvi = (b8 - b4)/np.maximum((b8 + b4), 1e-10)
     ndvi[(ndvi<-1)|(ndvi>1)] = NoDataValue
@@ -74,6 +135,124 @@ def get_analysis_array(filepath, start_end_dates=None):
     analysis_array[:, :, mask == 0] = NoDataValue
     return analysis_array
 
+def date_window(dates, start_end_dates):
+    """
+    Finds the range of a sorted list of dates that falls in a date window.
+
+    Parameters:
+        dates (list of str): Sorted dates formatted as "yyyy-mm-dd".
+        start_end_dates (list of str): Start and end date of the window. None selects all dates.
+
+    Returns:
+        slice: Range of dates in the window.
+    """
+    if start_end_dates is None:
+        return slice(0, len(dates))
+    return slice(bisect.bisect_left(dates, start_end_dates[0]), bisect.bisect_right(dates, start_end_dates[1]))
+
+def _sample_shape(filepath):
+    # Rows and columns of a sample directory, read from the header of its memory-mapped mask
+    if os.path.isdir(filepath):
+        return np.load(os.path.join(filepath, 'mask.npy'), mmap_mode='r').shape
+    return None
+
+def _fill_indices(out, sample, window, bands, scratch):
+    # Computes NDVI and CIre of one sample in place into out, of shape (dates, 2, rows, columns)
+    b4, b5, b7, b8 = np.moveaxis(np.asarray(sample['stack'][window, bands], dtype=np.float32), 1, 0)
+    ndvi = out[:, 0]
+    cire = out[:, 1]
+    np.add(b8, b4, out=scratch)
+    np.maximum(scratch, 1e-10, out=scratch)
+    np.subtract(b8, b4, out=ndvi)
+    np.divide(ndvi, scratch, out=ndvi)
+    np.copyto(ndvi, NoDataValue, where=(ndvi<-1)|(ndvi>1))
+    np.maximum(b5, 1e-10, out=scratch)
+    np.divide(b7, scratch, out=cire)
+    np.subtract(cire, 1, out=cire)
+    np.copyto(cire, NoDataValue, where=(cire<-1)|(cire>15))
+    out[:, :, np.asarray(sample['mask']) == 0] = NoDataValue
+
+def get_analysis_arrays(filepaths, start_end_dates=None):
+    """
+    Computes vegetation indices (NDVI and CIre) of many fields that share a band layout and dates.
+    Band and date indices are resolved once, and fields are loaded, computed and released one at
+    a time, so only one raw sample is in memory. When every field is a sample directory written by
+    convert_sample, the output shape is read from the array headers and the indices are computed in
+    place into one preallocated array; pickled fields are computed into compact per-field arrays that
+    are padded into the output at the end.
+
+    Parameters:
+        filepaths (list of str): Paths to the pickle files or sample directories of the fields.
+        start_end_dates (list of str, optional): List of start and end date for analysis. Defaults to None (all dates).
+
+    Returns:
+        array: float32 array of shape (fields, dates, 2, rows, columns) with NDVI and CIre values,
+            padded with NoDataValue to the largest field.
+    """
+    filepaths = list(filepaths)
+    if not filepaths:
+        return np.zeros((0, 0, 2, 0, 0), dtype=np.float32)
+    first = [load_sample(filepaths[0])]
+    dates = list(first[0]['dates'])
+    layout = list(first[0]['bands'])
+    bands = [layout.index(band) for band in ["B04", "B05", "B07", "B08"]]
+    window = date_window(dates, start_end_dates)
+    num_date = len(range(len(dates))[window])
+    def samples():
+        for k, filepath in enumerate(filepaths):
+            # The first sample is handed over rather than kept, so it is released after use like the others
+            current = first.pop() if k == 0 else load_sample(filepath)
+            if list(current['dates']) != dates or list(current['bands']) != layout:
+                raise ValueError("All fields must share the same dates and band layout")
+            yield k, current
+    shapes = [_sample_shape(filepath) for filepath in filepaths]
+    if all(shape is not None for shape in shapes):
+        height = max(shape[0] for shape in shapes)
+        width = max(shape[1] for shape in shapes)
+        analysis_arrays = np.full((len(filepaths), num_date, 2, height, width), NoDataValue, dtype=np.float32)
+        scratch = np.empty((num_date, height, width), dtype=np.float32)
+        for k, current in samples():
+            rows, cols = current['mask'].shape
+            _fill_indices(analysis_arrays[k, :, :, :rows, :cols], current, window, bands, scratch[:, :rows, :cols])
+        return analysis_arrays
+    fields = []
+    for k, current in samples():
+        rows, cols = current['mask'].shape
+        fields.append(np.empty((num_date, 2, rows, cols), dtype=np.float32))
+        _fill_indices(fields[-1], current, window, bands, np.empty((num_date, rows, cols), dtype=np.float32))
+    height = max(field.shape[2] for field in fields)
+    width = max(field.shape[3] for field in fields)
+    analysis_arrays = np.full((len(fields), num_date, 2, height, width), NoDataValue, dtype=np.float32)
+    for k in range(len(fields)):
+        analysis_arrays[k, :, :, :fields[k].shape[2], :fields[k].shape[3]] = fields[k]
+        fields[k] = None
+    return analysis_arrays
+
+def patch_origins(array, patch_height=3, patch_width=3, allow_overlap=False):
+    """
+    Finds the top-left pixel of every patch divide_image extracts from an array.
+
+    Parameters:
+        array (array): The input array.
+        patch_height (int, optional): height dimension in pixels of a resulting patch. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of a resulting patch. Defaults to 3.
+        allow_overlap (bool, optional): create overrlapping patches. Defaults to False (no overlap).
+
+    Returns:
+        array, array: row and column of each patch, in row-major order
+    """
+    # Get dimensions of the input array
+    num_date, channels, height, width = array.shape
+    if height < patch_height or width < patch_width:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    row_step = patch_height if allow_overlap==False else 1
+    col_step = patch_width if allow_overlap==False else 1
+    # A window is valid if no pixel in it holds NoDataValue on any date or channel
+    nodata = np.any(array == NoDataValue, axis=(0, 1))
+    nodata_windows = sliding_window_view(nodata, (patch_height, patch_width))[::row_step, ::col_step]
+    rows, cols = np.nonzero(~np.any(nodata_windows, axis=(2, 3)))
+    return rows * row_step, cols * col_step
+
 def divide_image(array, patch_height=3, patch_width=3, allow_overlap=False):
     """
     Divides larger array into smaller patches.
@@ -87,29 +266,84 @@ def divide_image(array, patch_height=3, patch_width=3, allow_overlap=False):
     Returns:
         array: array of resulting patches
     """
-    array = array.copy()
-    # Get dimensions of the input array
-    num_date, channels, height, width = array.shape
-    # Initialize lists to store patches and their positions
-    patches = []
-    i = 0
-    while i <= height - patch_height:
-        j = 0
-        while j <= width - patch_width:
-            # Initialize patch before extraction
-            patch = array[:, :, i:i+patch_height, j:j+patch_width]
-            # Check if all elements in the patch are valid (not equal to NoDataValue)
-            if np.all(patch != NoDataValue):
-                patches.append(patch.copy())
-            j += patch_width if allow_overlap==False else 1
-        i += patch_height if allow_overlap==False else 1
-    # Convert the list to numpy array before returning
-    return np.array(patches)
+    rows, cols = patch_origins(array, patch_height, patch_width, allow_overlap)
+    if len(rows) == 0:
+        return np.array([])
+    # Gather the valid windows (in row-major order) with one fancy-index into a strided view
+    windows = sliding_window_view(array, (patch_height, patch_width), axis=(2, 3))
+    patches = windows[:, :, rows, cols]
+    return np.ascontiguousarray(np.moveaxis(patches, 2, 0))
+
+def field_patches(filepath, patch_height=3, patch_width=3, allow_overlap=False, start_end_dates=None):
+    """
+    Computes vegetation indices of one downloaded field and divides them into patches.
+
+    Parameters:
+        filepath (str): The path to the pickle file with Sentinel data sample representing one field.
+        patch_height (int, optional): height dimension in pixels of a resulting patch. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of a resulting patch. Defaults to 3.
+        allow_overlap (bool, optional): create overrlapping patches. Defaults to False (no overlap).
+        start_end_dates (list of str, optional): List containing start and end dates for analysis. Defaults to None (all dates).
+
+    Returns:
+        array: array of resulting patches
+    """
+    analysis_array = get_analysis_array(filepath=filepath, start_end_dates=start_end_dates)
+    return divide_image(analysis_array, patch_height, patch_width, allow_overlap)
+
+def iter_patches(fids, filepath, patch_height=3, patch_width=3, allow_overlap=False,
+                 start_end_dates=["2022-05-11", "2022-10-09"], num_workers=1):
+    """
+    Downloads fields and divides them into patches, yielding the results in the order of fids.
+    With several workers, downloads run in a thread pool and index computation and patching
+    in a process pool, with at most 2*num_workers fields in flight.
+
+    Parameters:
+        fids (list of int): list of IDs to process.
+        filepath (str): File name pattern of the field pickles, formatted with the field ID.
+        patch_height (int, optional): height dimension in pixels of a resulting patch. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of a resulting patch. Defaults to 3.
+        allow_overlap (bool, optional): create overrlapping patches. Defaults to False (no overlap).
+        start_end_dates (list of str, optional): List containing start and end dates for analysis. Defaults to ["2022-05-11", "2022-10-09"].
+        num_workers (int, optional): Number of download threads and worker processes. Defaults to 1 (serial).
+
+    Yields:
+        int, array: Field ID and array of its patches.
+    """
+    options = (patch_height, patch_width, allow_overlap, start_end_dates)
+    if num_workers <= 1:
+        for fid in fids:
+            with cached_file(filepath.format(fid), bucket_path='csb/') as localpath:
+                patches = field_patches(localpath, *options)
+            yield fid, patches
+        return
+    # Workers are started from the download threads, and a child forked from this process would
+    # inherit the other threads' held locks, so they are forked from a single-threaded fork server
+    context = multiprocessing.get_context('forkserver')
+    with ThreadPoolExecutor(num_workers) as downloads, ProcessPoolExecutor(num_workers, mp_context=context) as pool:
+        def fetch(fid):
+            # Hands the downloaded field to the process pool as soon as it is on disk, leased
+            # until the worker is done with it so other downloads cannot evict it
+            leases = ExitStack()
+            localpath = download_file(bucket_path='csb/', filename=filepath.format(fid), leases=leases)
+            future = pool.submit(field_patches, localpath, *options)
+            future.add_done_callback(lambda _: leases.close())
+            return future
+        pending = deque()
+        for fid in fids:
+            pending.append((fid, downloads.submit(fetch, fid)))
+            if len(pending) >= 2 * num_workers:
+                fid, future = pending.popleft()
+                yield fid, future.result().result()
+        while pending:
+            fid, future = pending.popleft()
+            yield fid, future.result().result()
 
 def create_patches(fids, filepath, outfilepath, 
                    patch_height=3, patch_width=3,
                    allow_overlap=False,
-                   start_end_dates=["2022-05-11", "2022-10-09"]):
+                   start_end_dates=["2022-05-11", "2022-10-09"],
+                   num_workers=1):
     """
     Combines preparatory steps to generate patches (computes vegetation indices, 
     divides arrays into patches, and saves resulting data to a new pickle)
@@ -122,15 +356,265 @@ def create_patches(fids, filepath, outfilepath,
         y_dim (int, optional). Y dimension of resulting patches. Defaults to 3.
         allow_overlap (bool, optional): create overrlapping patches. Defaults to False (no overlap).
         start_end_dates (list of str, optional): List containing start and end dates for analysis. Defaults to ["2022-05-11", "2022-10-09"].
+        num_workers (int, optional): Number of parallel downloads and worker processes. Defaults to 1 (serial).
 
     Returns:
         None
     """
     file_dict = {}
-    for fid in fids:
-        analysis_array = get_analysis_array(
-            filepath=download_file(bucket_path='csb/', filename=filepath.format(fid)), 
-            start_end_dates=start_end_dates)
-        patches = divide_image(analysis_array, patch_height, patch_width, allow_overlap)
+    for fid, patches in iter_patches(fids, filepath, patch_height, patch_width,
+                                     allow_overlap, start_end_dates, num_workers):
         file_dict[fid] = patches
     save_pickle(file_dict, outfilepath)
+
+def plan_patch_shards(fids, filepath, outdir, num_shards,
+                      patch_height=3, patch_width=3,
+                      allow_overlap=False,
+                      start_end_dates=["2022-05-11", "2022-10-09"]):
+    """
+    Partitions field IDs into shards and writes the shard index (index.json) of a sharded patch run.
+
+    Parameters:
+        fids (list of int): list of IDs to process.
+        filepath (str): File name pattern of the field pickles, formatted with the field ID.
+        outdir (str): Directory of the run, where the shards are written.
+        num_shards (int): Number of shards (one Slurm array task each).
+        patch_height (int, optional): height dimension in pixels of a resulting patch. Defaults to 3.
+        patch_width (int, optional): width dimension in pixels of a resulting patch. Defaults to 3.
+        allow_overlap (bool, optional): create overrlapping patches. Defaults to False (no overlap).
+        start_end_dates (list of str, optional): List containing start and end dates for analysis. Defaults to ["2022-05-11", "2022-10-09"].
+
+    Returns:
+        dict: The shard index, with the patching options and the file and field IDs of each shard.
+    """
+    fids = [fid.item() if hasattr(fid, 'item') else fid for fid in fids]
+    index = {
+        'filepath': filepath,
+        'patch_height': patch_height,
+        'patch_width': patch_width,
+        'allow_overlap': allow_overlap,
+        'start_end_dates': start_end_dates,
+        'shards': [{'file': 'shard_{}.pkl'.format(x), 'fids': [fids[k] for k in part]}
+                   for x, part in enumerate(np.array_split(np.arange(len(fids)), num_shards))],
+    }
+    os.makedirs(outdir, exist_ok=True)
+    write_json(index, os.path.join(outdir, 'index.json'))
+    return index
+
+def run_patch_shard(outdir, x, num_workers=1):
+    """
+    Generates the patches of one shard of a sharded patch run, renaming the shard file into place once it is complete.
+
+    Parameters:
+        outdir (str): Directory of the run, prepared with plan_patch_shards.
+        x (int): Index of the shard (the Slurm array task index).
+        num_workers (int, optional): Number of parallel downloads and worker processes. Defaults to 1.
+
+    Returns:
+        str: Path of the shard file.
+    """
+    index = read_json(os.path.join(outdir, 'index.json'))
+    shard = os.path.join(outdir, index['shards'][x]['file'])
+    tmpfile = shard + '.tmp-{}'.format(os.getpid())
+    create_patches(index['shards'][x]['fids'], index['filepath'], tmpfile,
+                   index['patch_height'], index['patch_width'], index['allow_overlap'],
+                   index['start_end_dates'], num_workers)
+    os.replace(tmpfile, shard)
+    return shard
+
+def submit_patch_shards(outdir, num_workers=1, **kwargs):
+    """
+    Submits every shard of a sharded patch run as one task of a Slurm array.
+
+    Parameters:
+        outdir (str): Directory of the run, prepared with plan_patch_shards.
+        num_workers (int, optional): Worker processes (and CPUs) per task. Defaults to 1.
+        **kwargs: Further arguments for hpc4ag.slurm.submit_array (job_name, time, setup_cmds).
+
+    Returns:
+        int: Slurm job ID.
+    """
+    from simple_slurm import Slurm
+    index = read_json(os.path.join(outdir, 'index.json'))
+    command = 'python -m hpc4ag.preprocessing {} {} {}'.format(
+        os.path.abspath(outdir), Slurm.SLURM_ARRAY_TASK_ID, num_workers)
+    return submit_array(command, len(index['shards']), cpus_per_task=num_workers, **kwargs)
+
+def run_patch_shards_local(outdir, num_processes=1):
+    """
+    Runs every shard of a sharded patch run in a local process pool, standing in for the Slurm array.
+
+    Parameters:
+        outdir (str): Directory of the run, prepared with plan_patch_shards.
+        num_processes (int, optional): Number of shards processed at a time. Defaults to 1.
+
+    Returns:
+        list of str: Paths of the shard files.
+    """
+    index = read_json(os.path.join(outdir, 'index.json'))
+    with ProcessPoolExecutor(num_processes) as pool:
+        return list(pool.map(run_patch_shard, [outdir] * len(index['shards']), range(len(index['shards']))))
+
+def shard_files(outdir):
+    """
+    Lists the shard files of a complete sharded patch run, for loaders that take a list of
+    patch files (for example hpc4ag.modeling.make_dataset).
+
+    Parameters:
+        outdir (str): Directory of the run.
+
+    Returns:
+        list of str: Paths of the shard files, in shard order.
+    """
+    index = read_json(os.path.join(outdir, 'index.json'))
+    files = [os.path.join(outdir, shard['file']) for shard in index['shards']]
+    missing = [f for f in files if not os.path.exists(f)]
+    if missing:
+        raise RuntimeError("{} shards are not complete yet".format(len(missing)))
+    return files
+
+def save_patch_container(data, outpath, fids=None):
+    """
+    Writes patches as one contiguous float32 array of shape (patches, time, channel, row, column)
+    (patches.npy) plus the field IDs and the offset of each field's patches (index.json).
+
+    Parameters:
+        data (dict or str): dictionary with field IDs and corresponding patches, or the path to its pickle file.
+        outpath (str): Directory where the container is written.
+        fids (list of int, optional): Field order in the container, for example train IDs followed by
+            test IDs so each split is one contiguous slice. Defaults to None (order of data).
+
+    Returns:
+        None
+    """
+    if isinstance(data, str):
+        data = load_pickle(data)
+    fids = list(data.keys()) if fids is None else list(fids)
+    counts = [len(data[fid]) for fid in fids]
+    shapes = [data[fid].shape[1:] for fid in fids if len(data[fid])]
+    os.makedirs(outpath, exist_ok=True)
+    patches = np.lib.format.open_memmap(os.path.join(outpath, 'patches.npy'), mode='w+', dtype=np.float32,
+                                        shape=(sum(counts),) + (shapes[0] if shapes else (0, 0, 0, 0)))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+    for fid, start, stop in zip(fids, offsets[:-1], offsets[1:]):
+        if stop > start:
+            patches[start:stop] = data[fid]
+    patches.flush()
+    del patches
+    write_json({'fids': [fid.item() if hasattr(fid, 'item') else fid for fid in fids],
+                'offsets': offsets.tolist()}, os.path.join(outpath, 'index.json'))
+
+def load_patch_container(path, mmap_mode='r'):
+    """
+    Loads a patch container written by save_patch_container, memory-mapping the patches.
+
+    Parameters:
+        path (str): Directory of the container.
+        mmap_mode (str, optional): Memory-map mode passed to numpy.load. Defaults to 'r'.
+
+    Returns:
+        dict: Container with keys patches, fids and offsets (patches of fids[k] are patches[offsets[k]:offsets[k+1]]).
+    """
+    container = read_json(os.path.join(path, 'index.json'))
+    container['offsets'] = np.array(container['offsets'])
+    container['patches'] = np.load(os.path.join(path, 'patches.npy'), mmap_mode=mmap_mode)
+    return container
+
+def select_fields(container, fids):
+    """
+    Selects the patches of some fields of a patch container. Fields stored next to each other in
+    the requested order are returned as a view of the memory-mapped array, without a copy.
+
+    Parameters:
+        container (dict): Patch container as returned by load_patch_container.
+        fids (list of int): IDs of the fields to select.
+
+    Returns:
+        array, array: Patches of the fields, position in fids of the field of each patch.
+    """
+    position = {fid: k for k, fid in enumerate(container['fids'])}
+    ks = np.array([position[fid] for fid in fids], dtype=int)
+    offsets = container['offsets']
+    counts = offsets[ks + 1] - offsets[ks]
+    field_of_patch = np.repeat(np.arange(len(ks)), counts)
+    if len(ks) == 0 or np.all(np.diff(ks) == 1):
+        start = offsets[ks[0]] if len(ks) else 0
+        return container['patches'][start:start + counts.sum()], field_of_patch
+    rows = np.concatenate([np.arange(offsets[k], offsets[k + 1]) for k in ks])
+    return container['patches'][rows], field_of_patch
+
+def _chunk_modes(block):
+    # Most frequent value of each column of a float block, the smallest on ties as in DataFrame.mode
+    # (NaN for columns without calls); counts one small integer genotype code at a time
+    valid = ~np.isnan(block)
+    called = block[valid]
+    modes = np.full(block.shape[1], np.nan)
+    if len(called) == 0:
+        return modes
+    if np.any((called != np.round(called)) | (called < 0) | (called > 127)):
+        return pd.DataFrame(block).mode().iloc[0].to_numpy(dtype=np.float64) if len(block) else modes
+    n_values = int(called.max()) + 1
+    counts = np.zeros((n_values, block.shape[1]), dtype=np.int64)
+    for value in range(n_values):
+        counts[value] = np.count_nonzero(block == value, axis=0)
+    has_calls = valid.any(axis=0)
+    modes[has_calls] = np.argmax(counts[:, has_calls], axis=0)
+    return modes
+
+def locus_modes(data, chunk_size=1024, num_workers=1):
+    """
+    Computes the most frequent genotype of every locus (column), in chunks of loci.
+
+    Parameters:
+        data (array or pandas.DataFrame): Genotypes with samples in rows and loci in columns, NaN for missing calls.
+        chunk_size (int, optional): Number of loci processed at a time. Defaults to 1024.
+        num_workers (int, optional): Number of threads processing chunks in parallel. Defaults to 1.
+
+    Returns:
+        array: Mode of each locus (the smallest value on ties, NaN for loci without calls).
+    """
+    values = data.to_numpy(dtype=np.float64) if isinstance(data, pd.DataFrame) else data
+    starts = range(0, values.shape[1], chunk_size)
+    chunk = lambda start: _chunk_modes(np.asarray(values[:, start:start+chunk_size], dtype=np.float64))
+    if num_workers <= 1:
+        parts = [chunk(start) for start in starts]
+    else:
+        # NumPy releases the GIL in the counting loops, so threads share the matrix without copies
+        with ThreadPoolExecutor(num_workers) as pool:
+            parts = list(pool.map(chunk, starts))
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+def impute_mode(data, chunk_size=1024, num_workers=1):
+    """
+    Fills missing genotypes with the most frequent genotype of their locus, like
+    df.fillna(df.mode().iloc[0]) but with per-locus counts of small integer codes.
+
+    Parameters:
+        data (array or pandas.DataFrame): Genotypes with samples in rows and loci in columns, NaN for missing calls.
+            A float array is filled in place; a data frame is returned as a filled copy.
+        chunk_size (int, optional): Number of loci processed at a time. Defaults to 1024.
+        num_workers (int, optional): Number of threads processing chunks in parallel. Defaults to 1.
+
+    Returns:
+        array or pandas.DataFrame: The imputed genotypes.
+    """
+    if isinstance(data, pd.DataFrame):
+        # Only float columns can hold missing calls; fill them as one array instead of column by column
+        floats = [column for column, dtype in data.dtypes.items() if dtype.kind == 'f']
+        values = data[floats].to_numpy(dtype=np.float64, copy=True)
+        filled = pd.DataFrame(impute_mode(values, chunk_size, num_workers), index=data.index, columns=floats)
+        if len(floats) == data.shape[1]:
+            return filled[data.columns]
+        data = data.copy()
+        data[floats] = filled
+        return data
+    modes = locus_modes(data, chunk_size, num_workers)
+    for start in range(0, data.shape[1], chunk_size):
+        block = data[:, start:start+chunk_size]
+        np.copyto(block, modes[start:start+chunk_size], where=np.isnan(block))
+    return data
+
+if __name__ == '__main__':
+    # Entry point of the array tasks submitted by submit_patch_shards
+    import sys
+    run_patch_shard(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
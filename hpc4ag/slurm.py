@@ -0,0 +1,63 @@
+import os
+import json
+import datetime
+import tempfile
+
+def write_json(obj, filepath):
+    """
+    Writes an object to a JSON file atomically, so readers never see a partial file.
+
+    Parameters:
+        obj (object): JSON-serializable object.
+        filepath (str): The path to the JSON file.
+
+    Returns:
+        None
+    """
+    dirname = os.path.dirname(os.path.abspath(filepath))
+    fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmpfile, filepath)
+
+def read_json(filepath):
+    """
+    Reads an object from a JSON file.
+
+    Parameters:
+        filepath (str): The path to the JSON file.
+
+    Returns:
+        object: The object loaded from the file.
+    """
+    with open(filepath) as f:
+        return json.load(f)
+
+def submit_array(command, num_tasks, cpus_per_task=1, job_name='hpc4ag',
+                 time=datetime.timedelta(minutes=15), setup_cmds=('source /opt/hpc4ag/venv/bin/activate',)):
+    """
+    Submits a Slurm job array with simple_slurm, one task per index in range(num_tasks).
+
+    Parameters:
+        command (str): Command run by every task. $SLURM_ARRAY_TASK_ID expands to the task index.
+        num_tasks (int): Number of array tasks.
+        cpus_per_task (int, optional): CPUs requested per task. Defaults to 1.
+        job_name (str, optional): Slurm job name. Defaults to 'hpc4ag'.
+        time (datetime.timedelta, optional): Time limit per task. Defaults to 15 minutes.
+        setup_cmds (list of str, optional): Commands run before the task command. Defaults to
+            activating the class virtual environment.
+
+    Returns:
+        int: Slurm job ID.
+    """
+    from simple_slurm import Slurm
+    slurm = Slurm(
+        array=range(0, num_tasks),
+        cpus_per_task=cpus_per_task,
+        job_name=job_name,
+        output=f'{Slurm.JOB_NAME}_{Slurm.JOB_ARRAY_ID}.out',
+        time=time,
+    )
+    for cmd in setup_cmds:
+        slurm.add_cmd(cmd)
+    return slurm.sbatch(command)
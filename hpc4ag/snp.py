@@ -0,0 +1,872 @@
+import os
+import json
+import heapq
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from .slurm import read_json, write_json, submit_array
+
+MissingCode = -1
+PlinkColumns = ['FID', 'IID', 'PAT', 'MAT', 'SEX', 'PHENOTYPE']
+WordBits = 64
+result_columns = ['Sample1', 'Sample2', 'Total_sites', 'Diff_Sites', 'Percent_Diff']
+pair_dtype = np.dtype([('i', '<i4'), ('j', '<i4'), ('total', '<i4'), ('diff', '<i4'), ('percent', '<f4')])
+
+def encode_genotypes(df, chunk_size=256):
+    """
+    Encodes a marker-by-sample genotype table as a compact integer array.
+
+    Parameters:
+        df (pandas.DataFrame): Genotype table with markers (loci) in rows and samples in columns,
+            as read from the A-matrix CSV. Missing calls are NaN.
+        chunk_size (int, optional): Number of sample columns converted at a time. Defaults to 256.
+
+    Returns:
+        array, array: Sample-major int8 array of shape (samples, loci) holding the index of each
+            call in the array of distinct genotype values (MissingCode for missing calls),
+            array of distinct genotype values.
+    """
+    n_loci, n_samples = df.shape
+    # Collect the distinct genotype values one block of columns at a time
+    values = np.array([])
+    for start in range(0, n_samples, chunk_size):
+        block = df.iloc[:, start:start+chunk_size].to_numpy(dtype=np.float64)
+        values = np.union1d(values, np.unique(block[~np.isnan(block)]))
+    if len(values) > np.iinfo(np.int8).max:
+        raise ValueError("Too many distinct genotype values to encode: {}".format(len(values)))
+    codes = np.full((n_samples, n_loci), MissingCode, dtype=np.int8)
+    for start in range(0, n_samples, chunk_size):
+        block = df.iloc[:, start:start+chunk_size].to_numpy(dtype=np.float64).T
+        valid = ~np.isnan(block)
+        codes[start:start+block.shape[0]][valid] = np.searchsorted(values, block[valid])
+    return codes, values
+
+def pairwise_block(codes, n_values, row_start, row_stop, col_start, col_stop):
+    """
+    Counts shared and differing sites for every pair in a rectangular block of samples.
+
+    Parameters:
+        codes (array): Sample-major genotype codes as returned by encode_genotypes.
+        n_values (int): Number of distinct genotype values.
+        row_start, row_stop (int): Range of samples along the first axis of the block.
+        col_start, col_stop (int): Range of samples along the second axis of the block.
+
+    Returns:
+        array, array: Matrices of shape (rows, cols) with the number of sites called in both samples
+            and the number of those sites where the calls differ.
+    """
+    rows = codes[row_start:row_stop]
+    cols = codes[col_start:col_stop]
+    # Float32 matrix products are exact for counts up to 2**24
+    dtype = np.float32 if codes.shape[1] < 2**24 else np.float64
+    total = (rows != MissingCode).astype(dtype) @ (cols != MissingCode).astype(dtype).T
+    match = np.zeros_like(total)
+    for value in range(n_values):
+        match += (rows == value).astype(dtype) @ (cols == value).astype(dtype).T
+    total = total.astype(np.int64)
+    diff = total - match.astype(np.int64)
+    return total, diff
+
+def pack_codes(codes):
+    """
+    Packs genotype codes into 2-bit codes plus a missing bitmap, 64 loci per word.
+
+    Parameters:
+        codes (array): Sample-major genotype codes in the range 0-3 (MissingCode for missing calls).
+
+    Returns:
+        array, array, array: uint64 arrays of shape (samples, words) with the low bit of each code,
+            the high bit of each code and the bitmap of called sites.
+    """
+    n_loci = codes.shape[1]
+    padding = (-n_loci) % WordBits
+    if codes.max(initial=0) > 3:
+        raise ValueError("Genotype codes must fit in 2 bits to be packed")
+    codes = np.pad(codes, ((0, 0), (0, padding)), constant_values=MissingCode)
+    valid = codes != MissingCode
+    def pack(bits):
+        return np.ascontiguousarray(np.packbits(bits, axis=1, bitorder='little')).view('<u8')
+    return pack(valid & (codes & 1 == 1)), pack(valid & (codes & 2 == 2)), pack(valid)
+
+def popcount(words):
+    """
+    Counts the set bits of each word along the last axis.
+
+    Parameters:
+        words (array): Array of uint64 words.
+
+    Returns:
+        array: Number of set bits summed along the last axis.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    # 16-bit lookup table for NumPy versions without bitwise_count (four lookups per word)
+    words = np.ascontiguousarray(words)
+    counts = _popcount_table[words.view(np.uint16)].reshape(words.shape[:-1] + (-1,))
+    return counts.sum(axis=-1, dtype=np.int64)
+
+_popcount_table = np.array([bin(value).count('1') for value in range(1 << 16)], dtype=np.uint8)
+
+def packed_pairwise_block(lo, hi, valid, row_start, row_stop, col_start, col_stop, row_block=8, word_block=64):
+    """
+    Counts shared and differing sites for every pair in a rectangular block of samples
+    directly on packed genotype words, broadcasting blocks of rows against all columns
+    one block of words at a time.
+
+    Parameters:
+        lo, hi, valid (array): Packed genotypes as returned by pack_codes.
+        row_start, row_stop (int): Range of samples along the first axis of the block.
+        col_start, col_stop (int): Range of samples along the second axis of the block.
+        row_block (int, optional): Number of rows broadcast at a time. Defaults to 8.
+        word_block (int, optional): Number of words broadcast at a time. Defaults to 64.
+
+    Returns:
+        array, array: Matrices of shape (rows, cols) with the number of sites called in both samples
+            and the number of those sites where the calls differ.
+    """
+    row_stop = min(row_stop, len(valid))
+    col_stop = min(col_stop, len(valid))
+    total = np.zeros((row_stop - row_start, col_stop - col_start), dtype=np.int64)
+    diff = np.zeros_like(total)
+    for w in range(0, valid.shape[1], word_block):
+        words = slice(w, w + word_block)
+        col_lo = np.asarray(lo[col_start:col_stop, words])[None]
+        col_hi = np.asarray(hi[col_start:col_stop, words])[None]
+        col_valid = np.asarray(valid[col_start:col_stop, words])[None]
+        for r in range(row_start, row_stop, row_block):
+            rows = slice(r, min(r + row_block, row_stop))
+            shared = np.asarray(valid[rows, words])[:, None] & col_valid
+            total[r - row_start:rows.stop - row_start] += popcount(shared)
+            differ = (np.asarray(lo[rows, words])[:, None] ^ col_lo) | (np.asarray(hi[rows, words])[:, None] ^ col_hi)
+            diff[r - row_start:rows.stop - row_start] += popcount(differ & shared)
+    return total, diff
+
+def unpack_codes(lo, hi, valid, n_loci):
+    """
+    Unpacks packed genotype words of some samples back into genotype codes.
+
+    Parameters:
+        lo, hi, valid (array): Packed genotypes of the samples, as returned by pack_codes.
+        n_loci (int): Number of loci.
+
+    Returns:
+        array: Sample-major int8 genotype codes (MissingCode for missing calls).
+    """
+    def unpack(words):
+        return np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1, bitorder='little')[:, :n_loci]
+    codes = (unpack(lo) | (unpack(hi) << 1)).astype(np.int8)
+    codes[unpack(valid) == 0] = MissingCode
+    return codes
+
+def block_counts(genotypes, row_start, row_stop, col_start, col_stop, kernel='dense'):
+    """
+    Counts shared and differing sites for a block of pairs. Packed genotypes are unpacked block
+    by block for the dense (matrix product) kernel, which is faster than the packed kernel with NumPy.
+
+    Parameters:
+        genotypes (dict): Unpacked or packed genotypes, as returned by read_genotypes.
+        row_start, row_stop (int): Range of samples along the first axis of the block.
+        col_start, col_stop (int): Range of samples along the second axis of the block.
+        kernel (str, optional): "dense" (pairwise_block) or "packed" (packed_pairwise_block, packed
+            genotypes only). Defaults to "dense".
+
+    Returns:
+        array, array: Matrices of shared sites and differing sites.
+    """
+    if 'codes' in genotypes:
+        return pairwise_block(genotypes['codes'], len(genotypes['values']),
+                              row_start, row_stop, col_start, col_stop)
+    if kernel == 'packed':
+        return packed_pairwise_block(genotypes['lo'], genotypes['hi'], genotypes['valid'],
+                                     row_start, row_stop, col_start, col_stop)
+    def block_codes(start, stop):
+        return unpack_codes(*[genotypes[key][start:stop] for key in ['lo', 'hi', 'valid']], genotypes['n_loci'])
+    rows = block_codes(row_start, row_stop)
+    cols = rows if (row_start, row_stop) == (col_start, col_stop) else block_codes(col_start, col_stop)
+    codes = np.concatenate([rows, cols])
+    # Codes of packed genotypes are 0-3; only the values that occur need a matrix product
+    return pairwise_block(codes, int(codes.max(initial=0)) + 1, 0, len(rows), len(rows), len(codes))
+
+def _read_chunks(infile, chunk_size):
+    # Yields (layout, sample names, values) chunks of a CSV (loci in rows) or PLINK .raw file (samples in rows)
+    if infile.endswith('.raw'):
+        for chunk in pd.read_csv(infile, sep='\\s+', chunksize=chunk_size):
+            yield 'samples', list(chunk['IID'].astype(str)), chunk.drop(columns=PlinkColumns).to_numpy(np.float32)
+    else:
+        # Keep each chunk a whole number of words so chunks can be packed independently
+        loci_chunk = max(WordBits, chunk_size - chunk_size % WordBits)
+        for chunk in pd.read_csv(infile, index_col=0, chunksize=loci_chunk):
+            yield 'loci', list(chunk.columns), chunk.to_numpy(np.float32).T
+
+def _values_to_codes(values):
+    codes = np.full(values.shape, MissingCode, dtype=np.int8)
+    valid = ~np.isnan(values)
+    called = values[valid]
+    if np.any((called != np.round(called)) | (called < 0) | (called > 3)):
+        raise ValueError("Only genotype values 0, 1, 2 and 3 can be packed")
+    codes[valid] = called
+    return codes
+
+def convert_genotypes(infile, outpath, chunk_size=1024):
+    """
+    Converts an A-matrix CSV (loci in rows) or a PLINK .raw file (samples in rows) into the packed
+    genotype format, reading the input in chunks.
+
+    Parameters:
+        infile (str): Path to the CSV or .raw file.
+        outpath (str): Directory where the packed arrays are written.
+        chunk_size (int, optional): Number of input rows read at a time. Defaults to 1024.
+
+    Returns:
+        None
+    """
+    parts = {'lo': [], 'hi': [], 'valid': []}
+    samples = []
+    n_loci = 0
+    for layout, names, values in _read_chunks(infile, chunk_size):
+        lo, hi, valid = pack_codes(_values_to_codes(values))
+        for key, words in zip(['lo', 'hi', 'valid'], [lo, hi, valid]):
+            parts[key].append(words)
+        if layout == 'samples':
+            samples += names
+            n_loci = values.shape[1]
+        else:
+            samples = names
+            n_loci += values.shape[1]
+    axis = 0 if layout == 'samples' else 1
+    os.makedirs(outpath, exist_ok=True)
+    for key, words in parts.items():
+        np.save(os.path.join(outpath, key + '.npy'), np.concatenate(words, axis=axis))
+    with open(os.path.join(outpath, 'meta.json'), 'w') as f:
+        json.dump({'samples': samples, 'n_loci': n_loci}, f)
+
+def load_packed(path, mmap_mode='r'):
+    """
+    Loads packed genotypes written by convert_genotypes.
+
+    Parameters:
+        path (str): Directory with the packed arrays.
+        mmap_mode (str, optional): Memory-map mode passed to numpy.load. Defaults to 'r'.
+
+    Returns:
+        dict: Packed genotypes with keys lo, hi, valid, samples and n_loci.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        genotypes = json.load(f)
+    for key in ['lo', 'hi', 'valid']:
+        genotypes[key] = np.load(os.path.join(path, key + '.npy'), mmap_mode=mmap_mode)
+    return genotypes
+
+def read_genotypes(data):
+    """
+    Reads genotypes for pairwise comparison from a packed directory or an A-matrix CSV.
+
+    Parameters:
+        data (str): Directory written by convert_genotypes, or path to the A-matrix CSV.
+
+    Returns:
+        dict: Packed genotypes (see load_packed) or unpacked genotypes with keys codes, values and samples.
+    """
+    if os.path.isdir(data):
+        return load_packed(data)
+    df = pd.read_csv(data, index_col=0)
+    codes, values = encode_genotypes(df)
+    return {'codes': codes, 'values': values, 'samples': list(df.columns)}
+
+def percent_diff(total, diff):
+    """
+    Computes the percentage of differing sites, rounded like Perc_diff.
+
+    Parameters:
+        total (array): Number of sites called in both samples.
+        diff (array): Number of differing sites.
+
+    Returns:
+        array: Percentage of differing sites rounded to 2 decimals (NaN where no site is shared).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round((diff * 100) / total, 2)
+
+def share_genotypes(genotypes):
+    """
+    Publishes genotype arrays once so that worker processes can attach to them without copies.
+    Memory-mapped arrays are shared through their file, other arrays are copied into
+    shared memory blocks.
+
+    Parameters:
+        genotypes (dict): Unpacked or packed genotypes, as returned by read_genotypes.
+
+    Returns:
+        list of SharedMemory, dict: Shared memory blocks to release once the workers are done,
+            picklable description of the genotypes to pass to attach_genotypes.
+    """
+    blocks = []
+    descriptor = {}
+    for key, value in genotypes.items():
+        if isinstance(value, np.memmap):
+            descriptor[key] = {'file': value.filename, 'offset': value.offset,
+                               'shape': value.shape, 'dtype': value.dtype.str}
+        elif isinstance(value, np.ndarray) and key != 'values':
+            block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+            blocks.append(block)
+            descriptor[key] = {'shm': block.name, 'shape': value.shape, 'dtype': value.dtype.str}
+        else:
+            descriptor[key] = value
+    return blocks, descriptor
+
+def attach_genotypes(descriptor):
+    """
+    Attaches to genotype arrays published by share_genotypes.
+
+    Parameters:
+        descriptor (dict): Description of the genotypes as returned by share_genotypes.
+
+    Returns:
+        list of SharedMemory, dict: Attached shared memory blocks (keep them referenced while
+            the arrays are in use), genotypes with zero-copy array views.
+    """
+    blocks = []
+    genotypes = {}
+    for key, value in descriptor.items():
+        if isinstance(value, dict) and 'file' in value:
+            genotypes[key] = np.memmap(value['file'], dtype=value['dtype'], mode='r',
+                                       offset=value['offset'], shape=value['shape'])
+        elif isinstance(value, dict) and 'shm' in value:
+            block = shared_memory.SharedMemory(name=value['shm'])
+            blocks.append(block)
+            genotypes[key] = np.ndarray(value['shape'], dtype=value['dtype'], buffer=block.buf)
+        else:
+            genotypes[key] = value
+    return blocks, genotypes
+
+_worker_blocks = []
+_worker_genotypes = None
+
+def _init_worker(descriptor):
+    global _worker_blocks, _worker_genotypes
+    _worker_blocks, _worker_genotypes = attach_genotypes(descriptor)
+
+def _count_block(coords):
+    total, diff = block_counts(_worker_genotypes, *coords)
+    return coords, total.astype(np.int32), diff.astype(np.int32)
+
+def map_blocks(genotypes, coords, num_processors=1):
+    """
+    Counts shared and differing sites for a list of blocks, optionally in a pool of worker
+    processes that attach to the published genotypes and receive only block coordinates.
+
+    Parameters:
+        genotypes (dict): Unpacked or packed genotypes, as returned by read_genotypes.
+        coords (list of tuple): Blocks as (row_start, row_stop, col_start, col_stop).
+        num_processors (int, optional): Number of worker processes. Defaults to 1 (no pool).
+
+    Yields:
+        tuple, array, array: Block coordinates, matrices of shared sites and differing sites.
+    """
+    if num_processors <= 1:
+        for block in coords:
+            yield (block,) + block_counts(genotypes, *block)
+        return
+    blocks, descriptor = share_genotypes(genotypes)
+    try:
+        with mp.Pool(num_processors, initializer=_init_worker, initargs=(descriptor,)) as pool:
+            for result in pool.imap_unordered(_count_block, coords):
+                yield result
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def pairwise_distances(genotypes, block_size=256, num_processors=1):
+    """
+    Computes the all-vs-all Total_sites, Diff_Sites and Percent_Diff matrices in batched blocks.
+
+    Parameters:
+        genotypes (dict): Unpacked or packed genotypes, as returned by read_genotypes.
+        block_size (int, optional): Number of samples per block. Defaults to 256.
+        num_processors (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        array, array, array: Symmetric (samples, samples) matrices of shared sites, differing sites
+            and percentage difference.
+    """
+    n_samples = len(genotypes['samples'])
+    total = np.zeros((n_samples, n_samples), dtype=np.int64)
+    diff = np.zeros((n_samples, n_samples), dtype=np.int64)
+    coords = [(i, i+block_size, j, j+block_size)
+              for i in range(0, n_samples, block_size) for j in range(i, n_samples, block_size)]
+    for (i, _, j, _), block_total, block_diff in map_blocks(genotypes, coords, num_processors):
+        total[i:i+block_size, j:j+block_size] = block_total
+        diff[i:i+block_size, j:j+block_size] = block_diff
+        total[j:j+block_size, i:i+block_size] = block_total.T
+        diff[j:j+block_size, i:i+block_size] = block_diff.T
+    return total, diff, percent_diff(total, diff)
+
+def pair_partition(n_samples, num_partitions, x):
+    """
+    Returns the pairs that np.array_split assigns to partition x of the row-major list of
+    unique sample pairs, without building that list.
+
+    Parameters:
+        n_samples (int): Number of samples.
+        num_partitions (int): Number of partitions the pair list is split into.
+        x (int): Index of the partition.
+
+    Returns:
+        array, array: First and second sample index of each pair in the partition.
+    """
+    n_pairs = n_samples * (n_samples - 1) // 2
+    size, extra = divmod(n_pairs, num_partitions)
+    start = x * size + min(x, extra)
+    stop = start + size + (1 if x < extra else 0)
+    # Number of pairs that precede row i is i*n - i*(i+1)/2
+    rows = np.arange(n_samples)
+    offsets = rows * n_samples - rows * (rows + 1) // 2
+    k = np.arange(start, stop)
+    i = np.searchsorted(offsets, k, side='right') - 1
+    j = k - offsets[i] + i + 1
+    return i, j
+
+def compare_pairs(genotypes, i, j, block_size=256, num_processors=1):
+    """
+    Computes shared and differing sites for an arbitrary list of sample pairs, batching
+    the pairs by blocks of first samples.
+
+    Parameters:
+        genotypes (dict): Unpacked or packed genotypes, as returned by read_genotypes.
+        i, j (array): First and second sample index of each pair.
+        block_size (int, optional): Number of first samples per batch. Defaults to 256.
+        num_processors (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        array, array, array: Shared sites, differing sites and percentage difference for each pair.
+    """
+    i = np.asarray(i)
+    j = np.asarray(j)
+    total = np.zeros(len(i), dtype=np.int64)
+    diff = np.zeros(len(i), dtype=np.int64)
+    coords = []
+    if len(i) > 0:
+        for row_start in range(i.min(), i.max() + 1, block_size):
+            selected = (i >= row_start) & (i < row_start + block_size)
+            if selected.any():
+                coords.append((row_start, row_start+block_size, j[selected].min(), j[selected].max() + 1))
+    for (row_start, row_stop, col_start, _), block_total, block_diff in map_blocks(genotypes, coords, num_processors):
+        selected = (i >= row_start) & (i < row_stop)
+        total[selected] = block_total[i[selected] - row_start, j[selected] - col_start]
+        diff[selected] = block_diff[i[selected] - row_start, j[selected] - col_start]
+    return total, diff, percent_diff(total, diff)
+
+def choose_tile_size(n_samples, n_tasks, max_tile_size=256):
+    """
+    Picks a square tile size that leaves several tiles per task for load balancing.
+
+    Parameters:
+        n_samples (int): Number of samples.
+        n_tasks (int): Total number of workers the tiles are spread over (array tasks times processors).
+        max_tile_size (int, optional): Largest tile edge. Defaults to 256.
+
+    Returns:
+        int: Tile edge in samples.
+    """
+    # The upper triangle holds about (n/t)**2/2 tiles; aim for at least 4 per task
+    tile_size = int(np.ceil(n_samples / np.sqrt(8 * max(n_tasks, 1))))
+    return int(np.clip(tile_size, 1, max_tile_size))
+
+def upper_triangle_tiles(n_samples, tile_size):
+    """
+    Splits the upper triangle of the sample-by-sample matrix into square tiles.
+
+    Parameters:
+        n_samples (int): Number of samples.
+        tile_size (int): Tile edge in samples.
+
+    Returns:
+        list of tuple: Tiles as (row_start, row_stop, col_start, col_stop), diagonal tiles included.
+    """
+    return [(i, min(i+tile_size, n_samples), j, min(j+tile_size, n_samples))
+            for i in range(0, n_samples, tile_size) for j in range(i, n_samples, tile_size)]
+
+def tile_pair_count(tile):
+    """
+    Counts the unique sample pairs (i < j) inside a tile.
+
+    Parameters:
+        tile (tuple): Tile as (row_start, row_stop, col_start, col_stop).
+
+    Returns:
+        int: Number of pairs.
+    """
+    row_start, row_stop, col_start, col_stop = tile
+    if row_start == col_start:
+        rows = row_stop - row_start
+        return rows * (rows - 1) // 2
+    return (row_stop - row_start) * (col_stop - col_start)
+
+def assign_tiles(tiles, num_partitions):
+    """
+    Balances tiles across partitions by pair count, giving the largest remaining tile to
+    the least loaded partition.
+
+    Parameters:
+        tiles (list of tuple): Tiles as returned by upper_triangle_tiles.
+        num_partitions (int): Number of partitions (for example Slurm array tasks).
+
+    Returns:
+        list of list of tuple: Tiles of each partition, in row-major order.
+    """
+    order = sorted(range(len(tiles)), key=lambda k: (-tile_pair_count(tiles[k]), k))
+    loads = [(0, x) for x in range(num_partitions)]
+    assigned = [[] for _ in range(num_partitions)]
+    for k in order:
+        load, x = heapq.heappop(loads)
+        assigned[x].append(k)
+        heapq.heappush(loads, (load + tile_pair_count(tiles[k]), x))
+    return [[tiles[k] for k in sorted(ks)] for ks in assigned]
+
+def tile_results(tile, total, diff):
+    """
+    Extracts the unique pairs (i < j) of a computed tile.
+
+    Parameters:
+        tile (tuple): Tile as (row_start, row_stop, col_start, col_stop).
+        total, diff (array): Matrices of shared and differing sites of the tile.
+
+    Returns:
+        array, array, array, array, array: First and second sample index, shared sites,
+            differing sites and percentage difference of each pair.
+    """
+    row_start, _, col_start, _ = tile
+    rows, cols = np.indices(total.shape).reshape(2, -1)
+    i = rows + row_start
+    j = cols + col_start
+    keep = i < j
+    total = total.ravel()[keep].astype(np.int64)
+    diff = diff.ravel()[keep].astype(np.int64)
+    return i[keep], j[keep], total, diff, percent_diff(total, diff)
+
+def compare_tiles(genotypes, tiles, num_processors=1):
+    """
+    Computes every pair in a list of tiles, each tile as a single batched operation.
+    Pool workers pull tiles one at a time, which balances uneven tiles across processors.
+
+    Parameters:
+        genotypes (dict): Unpacked or packed genotypes, as returned by read_genotypes.
+        tiles (list of tuple): Tiles as returned by upper_triangle_tiles.
+        num_processors (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        array, array, array, array, array: First and second sample index, shared sites,
+            differing sites and percentage difference of each pair, in row-major order.
+    """
+    parts = [tile_results(tile, total, diff) for tile, total, diff in map_blocks(genotypes, tiles, num_processors)]
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty, percent_diff(empty, empty)
+    i, j, total, diff, percent = [np.concatenate(columns) for columns in zip(*parts)]
+    order = np.lexsort((j, i))
+    return i[order], j[order], total[order], diff[order], percent[order]
+
+def pairs_to_frame(samples, i, j, total, diff, percent):
+    """
+    Arranges pairwise results in the layout of the SNP comparison CSV files.
+
+    Parameters:
+        samples (list of str): Sample names.
+        i, j (array): First and second sample index of each pair.
+        total, diff, percent (array): Shared sites, differing sites and percentage difference.
+
+    Returns:
+        pandas.DataFrame: Data frame with columns Sample1, Sample2, Total_sites, Diff_Sites, Percent_Diff.
+    """
+    samples = np.asarray(samples, dtype=object)
+    return pd.DataFrame({
+        'Sample1': samples[i],
+        'Sample2': samples[j],
+        'Total_sites': total,
+        'Diff_Sites': diff,
+        'Percent_Diff': percent,
+    }, columns=result_columns)
+
+def distances_to_frame(samples, total, diff, percent):
+    """
+    Flattens all-vs-all matrices into the row-major list of unique pairs used by the SNP comparison CSV files.
+
+    Parameters:
+        samples (list of str): Sample names.
+        total, diff, percent (array): Matrices as returned by pairwise_distances.
+
+    Returns:
+        pandas.DataFrame: Data frame with columns Sample1, Sample2, Total_sites, Diff_Sites, Percent_Diff.
+    """
+    i, j = np.triu_indices(len(samples), k=1)
+    return pairs_to_frame(samples, i, j, total[i, j], diff[i, j], percent[i, j])
+
+def pairs_to_array(i, j, total, diff, percent):
+    """
+    Packs pairwise results into a typed record array with int32 sample indices and counts
+    and float32 percentages.
+
+    Parameters:
+        i, j (array): First and second sample index of each pair.
+        total, diff, percent (array): Shared sites, differing sites and percentage difference.
+
+    Returns:
+        array: Record array with dtype pair_dtype.
+    """
+    pairs = np.empty(len(i), dtype=pair_dtype)
+    pairs['i'] = i
+    pairs['j'] = j
+    pairs['total'] = total
+    pairs['diff'] = diff
+    pairs['percent'] = percent
+    return pairs
+
+def array_to_frame(samples, pairs):
+    """
+    Arranges a record array of pairwise results in the layout of the SNP comparison CSV files.
+
+    Parameters:
+        samples (list of str): Sample names.
+        pairs (array): Record array as returned by pairs_to_array.
+
+    Returns:
+        pandas.DataFrame: Data frame with columns Sample1, Sample2, Total_sites, Diff_Sites, Percent_Diff.
+    """
+    # Percentages are stored as float32; rounding the float64 value restores the 2-decimal CSV values
+    percent = np.round(pairs['percent'].astype(np.float64), 2)
+    return pairs_to_frame(samples, pairs['i'], pairs['j'], pairs['total'].astype(np.int64),
+                          pairs['diff'].astype(np.int64), percent)
+
+def save_pairs(filepath, pairs):
+    """
+    Writes a record array of pairwise results to a .npy file, renaming it into place once it is complete.
+
+    Parameters:
+        filepath (str): Path of the .npy file.
+        pairs (array): Record array as returned by pairs_to_array.
+
+    Returns:
+        None
+    """
+    tmpfile = filepath + '.tmp-{}'.format(os.getpid())
+    with open(tmpfile, 'wb') as f:
+        np.save(f, pairs)
+    os.replace(tmpfile, filepath)
+
+def condensed_index(n_samples, i, j):
+    """
+    Returns the position of pairs (i < j) in a condensed distance matrix, the row-major
+    list of unique pairs used by scipy.spatial.distance.
+
+    Parameters:
+        n_samples (int): Number of samples.
+        i, j (array): First and second sample index of each pair.
+
+    Returns:
+        array: Positions in the condensed matrix.
+    """
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    return n_samples * i - i * (i + 1) // 2 + j - i - 1
+
+def merge_pairs(files, n_samples, outfile, field='percent'):
+    """
+    Assembles .npy files of pairwise results into a condensed distance matrix on disk,
+    memory-mapping one file at a time so the parts are never all loaded together.
+
+    Parameters:
+        files (list of str): Paths of the .npy files written by save_pairs.
+        n_samples (int): Number of samples.
+        outfile (str): Path of the .npy file of the condensed matrix.
+        field (str, optional): Field of pair_dtype to assemble (total, diff or percent). Defaults to 'percent'.
+
+    Returns:
+        array: Memory-mapped condensed matrix (NaN, or -1 for counts, where no pair was found).
+    """
+    dtype = pair_dtype[field]
+    condensed = np.lib.format.open_memmap(outfile, mode='w+', dtype=dtype,
+                                          shape=(n_samples * (n_samples - 1) // 2,))
+    condensed[:] = np.nan if dtype.kind == 'f' else -1
+    for filepath in files:
+        pairs = np.load(filepath, mmap_mode='r')
+        condensed[condensed_index(n_samples, pairs['i'], pairs['j'])] = pairs[field]
+    condensed.flush()
+    return condensed
+
+def tile_path(outdir, k):
+    """
+    Returns the path of the result file of tile k in a checkpointed run.
+
+    Parameters:
+        outdir (str): Directory of the run.
+        k (int): Index of the tile in the manifest.
+
+    Returns:
+        str: Path of the tile result file.
+    """
+    return os.path.join(outdir, 'tiles', 'tile_{}.npy'.format(k))
+
+def plan_tiles(data, outdir, tile_size=256):
+    """
+    Starts a checkpointed pairwise comparison by writing the tile manifest of the run.
+    An existing manifest is kept, so planning again resumes the same run.
+
+    Parameters:
+        data (str): Genotype input accepted by read_genotypes.
+        outdir (str): Directory of the run.
+        tile_size (int, optional): Tile edge in samples. Defaults to 256.
+
+    Returns:
+        dict: The manifest, with keys data, samples, tile_size and tiles.
+    """
+    manifest_file = os.path.join(outdir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        return read_json(manifest_file)
+    samples = read_genotypes(data)['samples']
+    manifest = {
+        'data': os.path.abspath(data),
+        'samples': samples,
+        'tile_size': tile_size,
+        'tiles': upper_triangle_tiles(len(samples), tile_size),
+    }
+    os.makedirs(os.path.join(outdir, 'tiles'), exist_ok=True)
+    write_json(manifest, manifest_file)
+    return manifest
+
+def completed_tiles(outdir):
+    """
+    Lists the tiles of a checkpointed run whose results have been written.
+
+    Parameters:
+        outdir (str): Directory of the run.
+
+    Returns:
+        list of int: Indices of the completed tiles.
+    """
+    manifest = read_json(os.path.join(outdir, 'manifest.json'))
+    return [k for k in range(len(manifest['tiles'])) if os.path.exists(tile_path(outdir, k))]
+
+def missing_tiles(outdir):
+    """
+    Lists the tiles of a checkpointed run that still have to be computed.
+
+    Parameters:
+        outdir (str): Directory of the run.
+
+    Returns:
+        list of int: Indices of the missing tiles.
+    """
+    manifest = read_json(os.path.join(outdir, 'manifest.json'))
+    done = set(completed_tiles(outdir))
+    return [k for k in range(len(manifest['tiles'])) if k not in done]
+
+def write_tile(outdir, k, results):
+    """
+    Writes the results of one tile as typed columns, renaming the file into place once it is complete.
+
+    Parameters:
+        outdir (str): Directory of the run.
+        k (int): Index of the tile in the manifest.
+        results (tuple): Pair indices and counts as returned by tile_results.
+
+    Returns:
+        None
+    """
+    save_pairs(tile_path(outdir, k), pairs_to_array(*results))
+
+def run_tiles(outdir, round_id, task_id, num_processors=1):
+    """
+    Computes the tiles assigned to one array task of a submission round, writing each
+    tile as soon as it is done and skipping tiles that are already complete.
+
+    Parameters:
+        outdir (str): Directory of the run.
+        round_id (int): Submission round, as returned by submit_missing_tiles.
+        task_id (int): Index of the array task.
+        num_processors (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        None
+    """
+    manifest = read_json(os.path.join(outdir, 'manifest.json'))
+    assignment = read_json(os.path.join(outdir, 'round_{}.json'.format(round_id)))
+    done = set(completed_tiles(outdir))
+    todo = [k for k in assignment[task_id] if k not in done]
+    index = {tuple(manifest['tiles'][k]): k for k in todo}
+    genotypes = read_genotypes(manifest['data'])
+    for tile, total, diff in map_blocks(genotypes, list(index), num_processors):
+        write_tile(outdir, index[tile], tile_results(tile, total, diff))
+
+def submit_missing_tiles(outdir, num_partitions, num_processors, **kwargs):
+    """
+    Submits the tiles of a checkpointed run that are not complete yet as a Slurm array,
+    balanced over at most num_partitions tasks.
+
+    Parameters:
+        outdir (str): Directory of the run, prepared with plan_tiles.
+        num_partitions (int): Maximum number of array tasks.
+        num_processors (int): Worker processes (and CPUs) per task.
+        **kwargs: Further arguments for hpc4ag.slurm.submit_array (job_name, time, setup_cmds).
+
+    Returns:
+        int, int: Submission round and Slurm job ID, or None, None if every tile is complete.
+    """
+    from simple_slurm import Slurm
+    manifest = read_json(os.path.join(outdir, 'manifest.json'))
+    missing = missing_tiles(outdir)
+    if not missing:
+        return None, None
+    index = {tuple(manifest['tiles'][k]): k for k in missing}
+    assigned = assign_tiles(list(index), min(num_partitions, len(missing)))
+    round_id = len([f for f in os.listdir(outdir) if f.startswith('round_')])
+    write_json([[index[tile] for tile in tiles] for tiles in assigned],
+               os.path.join(outdir, 'round_{}.json'.format(round_id)))
+    command = 'python -m hpc4ag.snp {} {} {} {}'.format(
+        os.path.abspath(outdir), round_id, Slurm.SLURM_ARRAY_TASK_ID, num_processors)
+    job_id = submit_array(command, len(assigned), cpus_per_task=num_processors, **kwargs)
+    return round_id, job_id
+
+def collect_tiles(outdir):
+    """
+    Concatenates the results of every tile of a complete run.
+
+    Parameters:
+        outdir (str): Directory of the run.
+
+    Returns:
+        pandas.DataFrame: Data frame with columns Sample1, Sample2, Total_sites, Diff_Sites, Percent_Diff.
+    """
+    missing = missing_tiles(outdir)
+    if missing:
+        raise RuntimeError("{} tiles are not complete yet".format(len(missing)))
+    manifest = read_json(os.path.join(outdir, 'manifest.json'))
+    pairs = np.concatenate([np.load(tile_path(outdir, k)) for k in range(len(manifest['tiles']))])
+    return array_to_frame(manifest['samples'], pairs)
+
+def merge_tiles(outdir, field='percent'):
+    """
+    Assembles the tiles of a complete run into a condensed distance matrix, one tile at a time.
+    The matrix is written to condensed_<field>.npy in the run directory.
+
+    Parameters:
+        outdir (str): Directory of the run.
+        field (str, optional): Field of pair_dtype to assemble (total, diff or percent). Defaults to 'percent'.
+
+    Returns:
+        array: Memory-mapped condensed matrix in scipy.spatial.distance order.
+    """
+    missing = missing_tiles(outdir)
+    if missing:
+        raise RuntimeError("{} tiles are not complete yet".format(len(missing)))
+    manifest = read_json(os.path.join(outdir, 'manifest.json'))
+    files = [tile_path(outdir, k) for k in range(len(manifest['tiles']))]
+    return merge_pairs(files, len(manifest['samples']), os.path.join(outdir, 'condensed_{}.npy'.format(field)), field)
+
+if __name__ == '__main__':
+    # Entry point of the array tasks submitted by submit_missing_tiles
+    import sys
+    run_tiles(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
@@ -0,0 +1,252 @@
+import os
+import time
+import sys
+import atexit
+import shutil
+import signal
+from contextlib import ExitStack
+
+from .utils import download_file, file_lock
+
+# Storage tiers from fastest to slowest; HPC4AG_TIERS overrides them (separated by os.pathsep)
+default_tiers = ['/scratch.local/hpc4ag', '/scratch.global/hpc4ag', '/opt/hpc4ag/data']
+
+def _configured_tiers(tiers=None):
+    return (os.environ['HPC4AG_TIERS'].split(os.pathsep) if 'HPC4AG_TIERS' in os.environ else default_tiers) \
+        if tiers is None else list(tiers)
+
+def get_tiers(tiers=None):
+    """
+    Returns the storage tiers that exist on this node, fastest first.
+
+    Parameters:
+        tiers (list of str, optional): Tier directories, fastest first. Defaults to None
+            (HPC4AG_TIERS, or node-local scratch, global scratch and the shared data area).
+
+    Returns:
+        list of str: Existing tier directories.
+    """
+    return [tier for tier in _configured_tiers(tiers) if os.path.isdir(tier)]
+
+def resolve(dataset, tiers=None):
+    """
+    Finds the fastest tier that holds a dataset.
+
+    Parameters:
+        dataset (str): Dataset file or directory, relative to the tier roots (for example "3k-core-v7-chr1/chr1.vcf").
+        tiers (list of str, optional): Tier directories, fastest first. Defaults to None (see get_tiers).
+
+    Returns:
+        str: Path of the dataset in the fastest tier that holds it, or None.
+    """
+    for tier in get_tiers(tiers):
+        path = os.path.join(tier, dataset)
+        if os.path.exists(path):
+            return path
+    return None
+
+def staged_marker(target):
+    """
+    Returns the path of the marker that stage writes next to the copies it makes. Only copies
+    with a marker are ever removed.
+
+    Parameters:
+        target (str): Path of the staged dataset.
+
+    Returns:
+        str: Path of the marker file.
+    """
+    return target + '.staged'
+
+def _source(dataset, tiers, leases=None):
+    source = resolve(dataset, tiers)
+    if source is None:
+        source = download_file(bucket_path=os.path.dirname(dataset), filename=os.path.basename(dataset), leases=leases)
+    return source
+
+def _copy(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def current_job_id():
+    """
+    Returns the Slurm job that staged copies are registered to: the array job for array tasks,
+    so that all tasks of an array share one registration, or the job itself otherwise.
+
+    Returns:
+        str: Slurm job ID, or None outside Slurm.
+    """
+    return os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID'))
+
+def stage(dataset, tiers=None, job_id=None, release_at_exit=False):
+    """
+    Copies a dataset to the fastest tier (node-local scratch) once per node and returns the local copy.
+    Concurrent and later tasks of the same job on the node wait on a lock and share the same copy. A
+    dataset that no tier holds is downloaded from the object store. When the node-local tier does not
+    exist, or already holds a dataset that stage did not copy there, that path is returned as is and
+    never removed.
+
+    The copy is registered to the job and kept when the process exits, so sequential array tasks reuse
+    it; call release_all once the job is done on the node (for example from the last task or a Slurm
+    epilog) to remove the copies no other job uses.
+
+    Parameters:
+        dataset (str): Dataset file or directory, relative to the tier roots.
+        tiers (list of str, optional): Tier directories, fastest first. The first one is the node-local
+            tier copies are made in. Defaults to None (HPC4AG_TIERS or default_tiers).
+        job_id (str, optional): Job the copy is registered to. Defaults to None (current_job_id;
+            outside Slurm the copy is not registered and is kept).
+        release_at_exit (bool, optional): Release the copy when this process exits normally, for jobs
+            that stage from a single process (see exit_on_sigterm to also release on cancellation).
+            Defaults to False.
+
+    Returns:
+        str: Path of the staged dataset.
+    """
+    tiers = _configured_tiers(tiers)
+    local = tiers[0] if tiers else None
+    if local is None or not os.path.isdir(local):
+        return _source(dataset, tiers)
+    # A tier listed twice (or through a symlink) must never be treated as a copy of itself
+    others = [tier for tier in tiers[1:] if os.path.realpath(tier) != os.path.realpath(local)]
+    target = os.path.join(local, dataset)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    job_id = current_job_id() if job_id is None else str(job_id)
+    with file_lock(target + '.lock'):
+        if not os.path.exists(target):
+            partial = target + '.part-{}'.format(os.getpid())
+            _remove(partial)
+            with ExitStack() as leases:
+                _copy(_source(dataset, others, leases), partial)
+            open(staged_marker(target), 'w').close()
+            os.replace(partial, target)
+        elif not os.path.exists(staged_marker(target)):
+            # Put there by hand or by another tool, so not ours to remove
+            return target
+        if job_id is not None:
+            users = target + '.users'
+            os.makedirs(users, exist_ok=True)
+            open(os.path.join(users, job_id), 'w').close()
+            if release_at_exit:
+                atexit.register(release, target, job_id)
+    return target
+
+def exit_on_sigterm():
+    """
+    Makes SIGTERM exit the interpreter normally, so atexit handlers such as the one registered by
+    stage(..., release_at_exit=True) run when Slurm cancels the job or it times out. Replaces any
+    SIGTERM handler already installed, so scripts that handle the signal themselves should not call it.
+    Must be called from the main thread.
+
+    Returns:
+        None
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+def release(target, job_id=None):
+    """
+    Unregisters a job from a staged dataset and removes the copy if no other job uses it.
+    Only copies made by stage (see staged_marker) are removed.
+
+    Parameters:
+        target (str): Path of the staged dataset, as returned by stage.
+        job_id (str, optional): Job to unregister. Defaults to None (current_job_id).
+
+    Returns:
+        None
+    """
+    job_id = current_job_id() if job_id is None else str(job_id)
+    with file_lock(target + '.lock'):
+        users = target + '.users'
+        if job_id is not None and os.path.exists(os.path.join(users, job_id)):
+            os.remove(os.path.join(users, job_id))
+        if os.path.isdir(users) and not os.listdir(users):
+            os.rmdir(users)
+            if os.path.exists(staged_marker(target)):
+                _remove(target)
+                os.remove(staged_marker(target))
+
+def release_all(job_id=None, tiers=None):
+    """
+    Releases every dataset a job staged on this node (see release). Meant to run once the job is
+    done on the node, from its last task or from a Slurm epilog, for example
+    python -c "from hpc4ag.staging import release_all; release_all('$SLURM_ARRAY_JOB_ID')".
+
+    Parameters:
+        job_id (str, optional): Job to unregister. Defaults to None (current_job_id).
+        tiers (list of str, optional): Tier directories, fastest first. Defaults to None (HPC4AG_TIERS or default_tiers).
+
+    Returns:
+        list of str: Paths of the datasets the job was registered to.
+    """
+    job_id = current_job_id() if job_id is None else str(job_id)
+    tiers = _configured_tiers(tiers)
+    if job_id is None or not tiers or not os.path.isdir(tiers[0]):
+        return []
+    released = []
+    for root, dirs, _ in os.walk(tiers[0]):
+        for name in dirs:
+            if name.endswith('.users') and os.path.exists(os.path.join(root, name, job_id)):
+                target = os.path.join(root, name[:-len('.users')])
+                release(target, job_id)
+                released.append(target)
+        # Do not descend into user registrations or into the staged datasets themselves
+        dirs[:] = [name for name in dirs if not name.endswith('.users') and
+                   not os.path.exists(os.path.join(root, name + '.staged'))]
+    return released
+
+def probe_tier(tier, size=64 * 1024 * 1024, block_size=4 * 1024 * 1024):
+    """
+    Measures the sequential write and read throughput of a tier with a temporary file.
+    The write is synced to storage; the read may be served from the page cache when the file
+    is smaller than the free memory, so use a size larger than RAM for cold-read numbers.
+
+    Parameters:
+        tier (str): Tier directory.
+        size (int, optional): Size of the test file in bytes. Defaults to 64 MiB.
+        block_size (int, optional): Size of each read and write in bytes. Defaults to 4 MiB.
+
+    Returns:
+        dict: Throughput in MB/s with keys write and read.
+    """
+    path = os.path.join(tier, '.hpc4ag-probe-{}'.format(os.getpid()))
+    block = os.urandom(block_size)
+    try:
+        start = time.perf_counter()
+        with open(path, 'wb') as f:
+            for _ in range(0, size, block_size):
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            while f.read(block_size):
+                pass
+        read_time = time.perf_counter() - start
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return {'write': size / write_time / 1e6, 'read': size / read_time / 1e6}
+
+def rank_tiers(tiers=None, size=64 * 1024 * 1024):
+    """
+    Orders tiers by measured read throughput, fastest first, for example to pick the order passed to stage.
+
+    Parameters:
+        tiers (list of str, optional): Tier directories. Defaults to None (see get_tiers).
+        size (int, optional): Size of the test file in bytes. Defaults to 64 MiB.
+
+    Returns:
+        list of tuple: (tier, throughput dict) pairs, fastest first.
+    """
+    results = [(tier, probe_tier(tier, size)) for tier in get_tiers(tiers)]
+    return sorted(results, key=lambda result: -result[1]['read'])
@@ -1,27 +1,327 @@
 import os
+import time
+import fcntl
+import shutil
 import pickle
+import hashlib
 import requests
 import tempfile
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 tmpdir = tempfile.mkdtemp()
 
-def download_file(bucket_url="https://s3.msi.umn.edu/hpc4ag", bucket_path="", filename=""):
+def _default_cache_dir():
+    # Global scratch when the cluster has it, so the cache does not fill the home quota
+    scratch = '/scratch.global'
+    if os.path.isdir(scratch) and 'USER' in os.environ:
+        return os.path.join(scratch, os.environ['USER'], 'hpc4ag')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'hpc4ag')
+
+# Persistent download cache shared across sessions and Slurm tasks (size limit in bytes, 0 for none)
+cache_dir = os.environ.get('HPC4AG_CACHE', _default_cache_dir())
+cache_limit = int(os.environ.get('HPC4AG_CACHE_LIMIT', 20 * 1024**3))
+# Minimum number of seconds between two cleanups of stale partial downloads and orphaned lock files
+clean_interval = 3600
+
+def set_cache(root=None, limit=None):
+    """
+    Configures the persistent download cache, which also holds the VCF sidecars (see hpc4ag.vcf).
+    The cache starts in $HPC4AG_CACHE, or /scratch.global/$USER/hpc4ag when that file system exists,
+    or ~/.cache/hpc4ag otherwise, and is limited to $HPC4AG_CACHE_LIMIT bytes (20 GiB by default).
+    The least recently used entries are evicted once a download takes the cache over its limit.
+
+    Parameters:
+        root (str, optional): Cache directory. Defaults to None (keep the current one).
+        limit (int, optional): Maximum cache size in bytes, 0 for no limit. Defaults to None (keep the current one).
+
+    Returns:
+        None
+    """
+    global cache_dir, cache_limit
+    if root is not None:
+        cache_dir = root
+    if limit is not None:
+        cache_limit = limit
+
+@contextmanager
+def file_lock(lockfile, blocking=True, shared=False):
+    """
+    Holds an exclusive lock on a lock file, shared between threads, processes and nodes
+    that see the same file system. The lock file may be removed by a process holding the lock;
+    waiters then retry on the new file.
+
+    Parameters:
+        lockfile (str): The path to the lock file.
+        blocking (bool, optional): Wait for the lock. Defaults to True.
+        shared (bool, optional): Take a shared lock, which other shared holders do not exclude. Defaults to False.
+
+    Yields:
+        bool: True if the lock is held (always the case when blocking).
+    """
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    while True:
+        with open(lockfile, 'a') as f:
+            try:
+                fcntl.flock(f, mode if blocking else mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                # Retry if the file was removed or replaced while we waited for it
+                if not os.path.exists(lockfile) or os.stat(lockfile).st_ino != os.fstat(f.fileno()).st_ino:
+                    continue
+                yield True
+                return
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def file_sha256(filepath):
+    """
+    Computes the SHA-256 checksum of a file.
+
+    Parameters:
+        filepath (str): The path to the file.
+
+    Returns:
+        str: Hexadecimal checksum.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(fileurl):
+    """
+    Returns the path of a URL in the download cache. Entries are keyed by a hash of the URL
+    and keep the file name, so readers can still infer the format from the extension.
+
+    Parameters:
+        fileurl (str): URL of the file.
+
+    Returns:
+        str: Path of the cache entry.
+    """
+    key = hashlib.sha256(fileurl.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, key + '-' + os.path.basename(fileurl))
+
+def _remove_stale(path, age):
+    # Leftover partial downloads of crashed processes (downloads in progress keep their mtime fresh)
+    try:
+        if time.time() - os.stat(path).st_mtime > age:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _remove_orphan(lockfile, entry):
+    # Lock and lease files of entries that no longer exist
+    with file_lock(lockfile, blocking=False) as locked:
+        if locked and not os.path.exists(entry):
+            os.remove(lockfile)
+
+def _tree_size(path):
+    # Total size of the files under a directory entry
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def clean_cache(stale_age=3600):
+    """
+    Removes partial downloads older than stale_age and the lock and lease files of entries that
+    no longer exist.
+
+    Parameters:
+        stale_age (float, optional): Age in seconds after which a partial download is removed. Defaults to 3600.
+
+    Returns:
+        None
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if '.part-' in name:
+            _remove_stale(path, stale_age)
+        elif name.endswith('.lock') or name.endswith('.lease'):
+            _remove_orphan(path, path.rsplit('.', 1)[0])
+
+def _clean_cache_periodically():
+    # Runs clean_cache at most once per clean_interval across all processes sharing the cache,
+    # using the modification time of a stamp file, so downloads do not pay for a scan each
+    stamp = os.path.join(cache_dir, '.cleaned')
+    try:
+        if time.time() - os.stat(stamp).st_mtime < clean_interval:
+            return
+    except FileNotFoundError:
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    open(stamp, 'a').close()
+    os.utime(stamp)
+    clean_cache()
+
+def evict_cache(keep=()):
+    """
+    Removes the least recently used cache entries (downloaded files and VCF sidecar directories)
+    until the cache fits in cache_limit. Entries that are being downloaded, built or that are
+    leased (see cached_file) are skipped.
+    Does nothing (and lists nothing) without a cache limit.
+
+    Parameters:
+        keep (str or list of str, optional): Paths of entries that must not be evicted. Defaults to ().
+
+    Returns:
+        None
+    """
+    if not cache_limit or not os.path.isdir(cache_dir):
+        return
+    keep = {keep} if isinstance(keep, str) else set(keep)
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or '.part-' in name or name.endswith('.lock') or name.endswith('.lease'):
+            continue
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        elif os.path.isdir(path):
+            entries.append((os.stat(path).st_mtime, _tree_size(path), path))
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= cache_limit:
+            break
+        if path in keep:
+            continue
+        with file_lock(path + '.lock', blocking=False) as locked:
+            if not locked:
+                continue
+            with file_lock(path + '.lease', blocking=False) as unleased:
+                if unleased and os.path.isfile(path):
+                    os.remove(path)
+                    os.remove(path + '.lease')
+                    size -= entry_size
+                elif unleased and os.path.isdir(path):
+                    # Readers that mapped a sidecar keep their open files
+                    shutil.rmtree(path)
+                    os.remove(path + '.lease')
+                    size -= entry_size
+            if not os.path.exists(path):
+                os.remove(path + '.lock')
+
+def _fetch(fileurl, sha256=None, session=None, leases=None):
+    # Downloads a file into the cache once, leasing the entry before its lock is released;
+    # returns the path and whether it was downloaded (False on a cache hit)
+    cachefile = cache_path(fileurl)
+    downloaded = False
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(cachefile + '.lock'):
+        if (os.path.isfile(cachefile)):
+            # Mark the entry as recently used for LRU eviction
+            os.utime(cachefile)
+        else:
+            partfile = cachefile + '.part-{}'.format(os.getpid())
+            try:
+                with (session or requests).get(fileurl, stream=True) as r:
+                    r.raise_for_status()
+                    with open(partfile, 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=1 << 20):
+                            f.write(chunk)
+                if sha256 is not None and file_sha256(partfile) != sha256:
+                    raise ValueError("Checksum mismatch for {}".format(fileurl))
+                os.replace(partfile, cachefile)
+                downloaded = True
+            finally:
+                if os.path.exists(partfile):
+                    os.remove(partfile)
+        if leases is not None:
+            leases.enter_context(file_lock(cachefile + '.lease', shared=True))
+    return cachefile, downloaded
+
+def download_file(bucket_url="https://s3.msi.umn.edu/hpc4ag", bucket_path="", filename="", sha256=None, session=None,
+                  leases=None):
+    """
+    Returns a local path to a file of the bucket, downloading it into the persistent cache if needed.
+    Downloads are written to a partial file and renamed once complete, under a per-file lock,
+    so concurrent workers fetch each file once and never see a partial file.
+    The entry can be evicted by later downloads once this returns unless it is leased: use
+    cached_file, or pass an ExitStack as leases and close it when done with the file.
+
+    Parameters:
+        bucket_url (str, optional): URL of the bucket. Defaults to the class bucket.
+        bucket_path (str, optional): Path of the file in the bucket. Defaults to "".
+        filename (str): Name of the file.
+        sha256 (str, optional): Expected SHA-256 checksum of a download. Defaults to None (not verified).
+        session (requests.Session, optional): HTTP session to reuse connections. Defaults to None.
+        leases (contextlib.ExitStack, optional): Stack that holds a lease on the entry until it is closed.
+            Defaults to None (no lease).
+
+    Returns:
+        str: Path to the local file.
+    """
     fileurl = '/'.join([bucket_url.strip('/'), bucket_path.strip('/'), filename.strip('/')])
     gemslearningfile = os.path.join('/opt/hpc4ag/data', filename)
     if (os.path.isfile(gemslearningfile)):
         # We've already made this available in the shared area
         return gemslearningfile
-    tmpfile = os.path.join(tmpdir, filename)
-    if (os.path.isfile(tmpfile)):
-        # Assume the file was already fetched once where the code accesses 
-        # the file more than once
-        return tmpfile
-    with requests.get(fileurl, stream=True) as r:
-        r.raise_for_status()
-        with open(tmpfile, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-    return tmpfile
+    cachefile, downloaded = _fetch(fileurl, sha256, session, leases)
+    if downloaded:
+        # Only a download grows the cache; cache hits touch nothing but their own entry
+        evict_cache(keep=cachefile)
+        _clean_cache_periodically()
+    return cachefile
+
+@contextmanager
+def cached_file(filename, bucket_url="https://s3.msi.umn.edu/hpc4ag", bucket_path="", sha256=None, session=None):
+    """
+    Downloads a file like download_file and leases it, so no eviction removes it while the block runs.
+
+    Parameters:
+        filename (str): Name of the file.
+        (other parameters as in download_file)
+
+    Yields:
+        str: Path to the local file.
+    """
+    with ExitStack() as leases:
+        yield download_file(bucket_url, bucket_path, filename, sha256, session, leases)
+
+def prefetch(filenames, bucket_url="https://s3.msi.umn.edu/hpc4ag", bucket_path="", checksums=None, num_workers=8,
+             leases=None):
+    """
+    Downloads a list of files of the bucket concurrently into the cache over one pooled HTTP session.
+    Files of the batch never evict each other; the cache is trimmed once the whole batch is in.
+
+    Parameters:
+        filenames (list of str): Names of the files.
+        bucket_url (str, optional): URL of the bucket. Defaults to the class bucket.
+        bucket_path (str, optional): Path of the files in the bucket. Defaults to "".
+        checksums (dict, optional): Expected SHA-256 checksum of each file name. Defaults to None.
+        num_workers (int, optional): Number of concurrent downloads. Defaults to 8.
+        leases (contextlib.ExitStack, optional): Stack that holds a lease on every file until it is closed,
+            so later downloads cannot evict them. Defaults to None (no lease).
+
+    Returns:
+        list of str: Local paths of the files, in the order of filenames.
+    """
+    checksums = checksums or {}
+    def fetch(filename):
+        shared = os.path.join('/opt/hpc4ag/data', filename)
+        if os.path.isfile(shared):
+            return shared
+        fileurl = '/'.join([bucket_url.strip('/'), bucket_path.strip('/'), filename.strip('/')])
+        return _fetch(fileurl, checksums.get(filename), session, leases)[0]
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(num_workers) as pool:
+            paths = list(pool.map(fetch, filenames))
+    cached = {path for path in paths if path.startswith(cache_dir)}
+    batch_size = sum(os.path.getsize(path) for path in cached)
+    if cache_limit and batch_size > cache_limit:
+        raise ValueError("The {} files need {} bytes, more than the cache limit of {} bytes".format(
+            len(filenames), batch_size, cache_limit))
+    evict_cache(keep=cached)
+    _clean_cache_periodically()
+    return paths
 
 
 def get_tmpdest(filename):
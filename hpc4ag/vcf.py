@@ -0,0 +1,260 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from .utils import cache_path, file_lock
+
+MissingGenotype = -1
+FixedColumns = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT']
+
+def read_header(filepath):
+    """
+    Parses the header of a VCF file.
+
+    Parameters:
+        filepath (str): The path to the VCF file.
+
+    Returns:
+        list of str, list of str, int: Meta-information lines (without the leading ##),
+            column names of the #CHROM line (CHROM first), number of header lines.
+    """
+    meta = []
+    with open(filepath) as f:
+        for n_lines, line in enumerate(f, start=1):
+            if line.startswith('##'):
+                meta.append(line[2:].rstrip('\n'))
+            elif line.startswith('#'):
+                return meta, line[1:].rstrip('\n').split('\t'), n_lines
+    raise ValueError("No #CHROM header line in {}".format(filepath))
+
+def _genotype_code(gt):
+    # Number of non-reference alleles of a GT field such as 0/1, 1|1, 0/2:35:... (MissingGenotype if any allele is missing)
+    alleles = str(gt).split(':', 1)[0].replace('|', '/').split('/')
+    if any(allele in ('.', '', 'nan') for allele in alleles):
+        return MissingGenotype
+    return sum(allele != '0' for allele in alleles)
+
+def encode_gt(values):
+    """
+    Encodes VCF genotype fields as int8 alternate allele counts.
+
+    Parameters:
+        values (array): Genotype fields (strings such as "0/1" or "1|1:12:...").
+
+    Returns:
+        array: int8 array of the same shape with 0, 1, 2 (non-reference allele count) or MissingGenotype.
+    """
+    # A chunk holds few distinct genotype strings, so each is parsed once
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object).ravel(), use_na_sentinel=False)
+    lookup = np.array([_genotype_code(gt) for gt in uniques], dtype=np.int8)
+    return lookup[codes].reshape(np.shape(values))
+
+def parse_region(region):
+    """
+    Parses a region given as "chrom", "chrom:start-end" or (chrom, start, end).
+
+    Parameters:
+        region (str or tuple): The region. Positions are 1-based and inclusive.
+
+    Returns:
+        str, int, int: Chromosome, start and end position (None for open ends).
+    """
+    if not isinstance(region, str):
+        return tuple(region)
+    if ':' not in region:
+        return region, None, None
+    chrom, span = region.rsplit(':', 1)
+    start, end = span.replace(',', '').split('-')
+    return chrom, int(start), int(end)
+
+def _region_mask(variants, region):
+    chrom, start, end = parse_region(region)
+    mask = (variants['CHROM'] == str(chrom)).to_numpy(dtype=bool, copy=True)
+    if start is not None:
+        mask &= variants['POS'].to_numpy() >= start
+    if end is not None:
+        mask &= variants['POS'].to_numpy() <= end
+    return mask
+
+def iter_vcf_chunks(filepath, samples=None, region=None, columns=('CHROM', 'POS', 'ID', 'REF', 'ALT'), chunk_size=10000):
+    """
+    Streams a VCF file in chunks of variants, encoding the GT fields straight into int8 arrays.
+
+    Parameters:
+        filepath (str): The path to the VCF file.
+        samples (list of str, optional): Samples to read. Defaults to None (all samples).
+        region (str or tuple, optional): Region to read (see parse_region). Defaults to None (whole file).
+        columns (list of str, optional): Fixed columns to read. Defaults to CHROM, POS, ID, REF and ALT.
+        chunk_size (int, optional): Number of variants parsed at a time. Defaults to 10000.
+
+    Yields:
+        pandas.DataFrame, array: Fixed columns of the chunk, int8 genotypes of shape (variants, samples).
+    """
+    _, names, n_header = read_header(filepath)
+    names[0] = 'CHROM'
+    all_samples = names[len(FixedColumns):]
+    samples = all_samples if samples is None else list(samples)
+    missing = set(samples) - set(all_samples)
+    if missing:
+        raise KeyError("Samples not in {}: {}".format(filepath, sorted(missing)))
+    fixed = list(columns) + [c for c in ['CHROM', 'POS'] if region is not None and c not in columns]
+    dtypes = {name: str for name in names}
+    dtypes['POS'] = np.int64
+    reader = pd.read_csv(filepath, sep='\t', skiprows=n_header, header=None, names=names,
+                         usecols=fixed + samples, dtype=dtypes, chunksize=chunk_size)
+    for chunk in reader:
+        if region is not None:
+            chunk = chunk[_region_mask(chunk, region)]
+        yield chunk[list(columns)].reset_index(drop=True), encode_gt(chunk[samples].to_numpy())
+
+def sidecar_path(filepath, sidecar_dir=None):
+    """
+    Returns the directory of the binary sidecar cache of a VCF file. Sidecars are keyed by the
+    absolute path of the VCF, so files in read-only shared areas can be cached.
+
+    Parameters:
+        filepath (str): The path to the VCF file.
+        sidecar_dir (str, optional): Directory holding the sidecars. Defaults to None (the download
+            cache, see hpc4ag.utils.set_cache).
+
+    Returns:
+        str: Path of the sidecar directory.
+    """
+    filepath = os.path.abspath(filepath)
+    if sidecar_dir is None:
+        return cache_path(filepath) + '.hpc4ag'
+    return os.path.join(sidecar_dir, os.path.basename(cache_path(filepath)) + '.hpc4ag')
+
+def build_sidecar(filepath, chunk_size=10000, sidecar_dir=None):
+    """
+    Parses a whole VCF file once into a binary sidecar: a raw int8 genotype matrix, the fixed
+    columns as a pickle and meta.json with the samples, the shape and the size and modification
+    time of the source file. The sidecar is written to a temporary directory and moved into place
+    under a file lock, so concurrent tasks build it once and readers never see a partial sidecar.
+
+    Parameters:
+        filepath (str): The path to the VCF file.
+        chunk_size (int, optional): Number of variants parsed at a time. Defaults to 10000.
+        sidecar_dir (str, optional): Directory holding the sidecars. Defaults to None (see sidecar_path).
+
+    Returns:
+        str: Path of the sidecar directory.
+    """
+    outpath = sidecar_path(filepath, sidecar_dir)
+    parent = os.path.dirname(outpath)
+    os.makedirs(parent, exist_ok=True)
+    with file_lock(outpath + '.lock'):
+        if sidecar_is_current(filepath, sidecar_dir):
+            # Built by another task while we waited for the lock
+            return outpath
+        tmppath = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        try:
+            _, names, _ = read_header(filepath)
+            samples = names[len(FixedColumns):]
+            variants = []
+            n_variants = 0
+            with open(os.path.join(tmppath, 'genotypes.i1'), 'wb') as f:
+                for chunk, genotypes in iter_vcf_chunks(filepath, columns=FixedColumns[:7], chunk_size=chunk_size):
+                    genotypes.tofile(f)
+                    variants.append(chunk)
+                    n_variants += len(chunk)
+            pd.concat(variants, ignore_index=True).to_pickle(os.path.join(tmppath, 'variants.pkl'))
+            stat = os.stat(filepath)
+            with open(os.path.join(tmppath, 'meta.json'), 'w') as f:
+                json.dump({'samples': samples, 'shape': [n_variants, len(samples)],
+                           'source_size': stat.st_size, 'source_mtime': stat.st_mtime}, f)
+            if os.path.exists(outpath):
+                # Replace an outdated sidecar; readers that mapped its genotypes keep their open file
+                stale = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+                os.replace(outpath, os.path.join(stale, 'old'))
+                shutil.rmtree(stale)
+            os.replace(tmppath, outpath)
+        finally:
+            if os.path.exists(tmppath):
+                shutil.rmtree(tmppath)
+    return outpath
+
+def sidecar_is_current(filepath, sidecar_dir=None):
+    """
+    Checks that the sidecar of a VCF file exists and was built from the current file.
+
+    Parameters:
+        filepath (str): The path to the VCF file.
+        sidecar_dir (str, optional): Directory holding the sidecars. Defaults to None (see sidecar_path).
+
+    Returns:
+        bool: True if the sidecar can be used.
+    """
+    meta_file = os.path.join(sidecar_path(filepath, sidecar_dir), 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    stat = os.stat(filepath)
+    return meta['source_size'] == stat.st_size and meta['source_mtime'] == stat.st_mtime
+
+def read_vcf(filepath, samples=None, region=None, columns=('CHROM', 'POS', 'ID', 'REF', 'ALT'),
+             chunk_size=10000, cache=False, sidecar_dir=None):
+    """
+    Reads the genotypes of a VCF file as a compact int8 matrix with bounded memory.
+
+    Parameters:
+        filepath (str): The path to the VCF file.
+        samples (list of str, optional): Samples to read. Defaults to None (all samples).
+        region (str or tuple, optional): Region to read, as "chrom", "chrom:start-end" or (chrom, start, end).
+            Defaults to None (whole file).
+        columns (list of str, optional): Fixed columns to read (CHROM to FILTER). Defaults to CHROM, POS, ID, REF and ALT.
+        chunk_size (int, optional): Number of variants parsed at a time. Defaults to 10000.
+        cache (bool, optional): Build (once) and use the binary sidecar, so repeat loads memory-map
+            the genotypes instead of parsing the file. Defaults to False.
+        sidecar_dir (str, optional): Directory holding the sidecars. Defaults to None (the download cache).
+
+    Returns:
+        dict: Genotypes with keys variants (pandas.DataFrame of the fixed columns), genotypes
+            (int8 array of shape (variants, samples) with non-reference allele counts, MissingGenotype
+            for missing calls) and samples.
+    """
+    if not cache:
+        variants = []
+        genotypes = []
+        for chunk, chunk_genotypes in iter_vcf_chunks(filepath, samples, region, columns, chunk_size):
+            variants.append(chunk)
+            genotypes.append(chunk_genotypes)
+        samples = read_header(filepath)[1][len(FixedColumns):] if samples is None else list(samples)
+        if not variants:
+            return {'variants': pd.DataFrame(columns=list(columns)),
+                    'genotypes': np.zeros((0, len(samples)), dtype=np.int8), 'samples': samples}
+        return {'variants': pd.concat(variants, ignore_index=True),
+                'genotypes': np.concatenate(genotypes), 'samples': samples}
+    outpath = sidecar_path(filepath, sidecar_dir)
+    while True:
+        if not sidecar_is_current(filepath, sidecar_dir):
+            build_sidecar(filepath, chunk_size, sidecar_dir)
+        # A shared lock keeps a rebuild or an eviction from removing the sidecar while its files are opened
+        with file_lock(outpath + '.lock', shared=True):
+            if not os.path.isdir(outpath):
+                # Evicted from the download cache since it was built
+                continue
+            # Marks the sidecar as recently used for the cache eviction
+            os.utime(outpath)
+            with open(os.path.join(outpath, 'meta.json')) as f:
+                meta = json.load(f)
+            variants = pd.read_pickle(os.path.join(outpath, 'variants.pkl'))
+            genotypes = np.memmap(os.path.join(outpath, 'genotypes.i1'), dtype=np.int8, mode='r',
+                                  shape=tuple(meta['shape'])) if meta['shape'][0] else np.zeros(meta['shape'], dtype=np.int8)
+        break
+    if region is not None:
+        rows = np.flatnonzero(_region_mask(variants, region))
+        # Regions of a sorted file are contiguous, which keeps the genotypes a memory-mapped view
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            rows = slice(rows[0], rows[-1] + 1)
+        variants = variants.iloc[rows].reset_index(drop=True)
+        genotypes = genotypes[rows]
+    if samples is not None:
+        position = {sample: k for k, sample in enumerate(meta['samples'])}
+        genotypes = genotypes[:, [position[sample] for sample in samples]]
+    return {'variants': variants[list(columns)], 'genotypes': genotypes,
+            'samples': meta['samples'] if samples is None else list(samples)}
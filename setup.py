@@ -7,5 +7,5 @@ setup(
    author='Olena Boiko',
    author_email='oboiko@umn.edu',
    packages=['hpc4ag'],
-   install_requires=['matplotlib', 'numpy', 'seaborn', 'scikit-learn', 'tensorflow'],
+   install_requires=['matplotlib', 'numpy', 'pandas', 'seaborn', 'scikit-learn', 'tensorflow'],
 )
\ No newline at end of file